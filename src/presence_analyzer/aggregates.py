@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Weekday aggregation of columnar presence data.
+"""
+
+from array import array
+from itertools import compress, imap, izip, repeat
+from operator import add, mod, mul, sub
+
+from presence_analyzer.metrics import timed
+
+# Statistics computed for every weekday.
+FIELDS = ('duration', 'start', 'end')
+# Percentiles reported by summarize().
+PERCENTILES = (10, 50, 90)
+# Presence times are seconds since midnight.
+DAY_SECONDS = 24 * 60 * 60
+# Layout of a single weekday of weekday_totals().
+TOTALS_LAYOUT = (
+    'count',
+    'duration_sum', 'start_sum', 'end_sum',
+    'duration_min', 'duration_max',
+    'start_min', 'start_max',
+    'end_min', 'end_max',
+)
+
+
+def group_by_weekday(days, starts, ends):
+    """
+    Partitions (days, starts, ends) columns by weekday in a single pass.
+
+    Returns list of seven (durations, starts, ends) lists, Monday is 0.
+    """
+    groups = [([], [], []) for _ in range(7)]
+    for day, start, end in izip(days, starts, ends):
+        durations, group_starts, group_ends = groups[(day + 6) % 7]
+        durations.append(end - start)
+        group_starts.append(start)
+        group_ends.append(end)
+    return groups
+
+
+def weekday_totals(days, starts, ends):
+    """
+    Aggregates (days, starts, ends) columns of a single user by weekday.
+
+    Rows are partitioned by group_by_weekday(), the totals are then
+    computed by builtin sum/min/max. Returns compact tuple of seven tuples
+    (one per weekday, Monday is 0) laid out as TOTALS_LAYOUT.
+    """
+    return tuple(
+        (len(group[0]),) +
+        tuple(sum(values) for values in group) +
+        tuple(
+            extreme(values) if values else None
+            for values in group
+            for extreme in (min, max)
+        )
+        for group in group_by_weekday(days, starts, ends)
+    )
+
+
+def expand_totals(totals):
+    """
+    Converts weekday_totals() into list of seven dicts indexed by weekday:
+    {
+        'count': 2,
+        'duration': {'count': 2, 'sum': 59000, 'mean': 29500.0, ...},
+        'start': {'count': 2, 'sum': 66600, 'mean': 33300.0, ...},
+        'end': {'count': 2, 'sum': 125600, 'mean': 62800.0, ...},
+    }
+    """
+    result = []
+    for weekday in totals:
+        count = weekday[0]
+        stats = {'count': count}
+        for i, field in enumerate(FIELDS):
+            total = weekday[1 + i]
+            stats[field] = {
+                'count': count,
+                'sum': total,
+                'mean': float(total) / count if count > 0 else 0,
+                'min': weekday[4 + 2 * i],
+                'max': weekday[5 + 2 * i],
+            }
+        result.append(stats)
+    return result
+
+
+def merge_totals(many):
+    """
+    Merges weekday_totals() of many users into totals of all their rows.
+    """
+    result = [[0, 0, 0, 0] + [None] * 6 for _ in range(7)]
+    for totals in many:
+        for merged, weekday in izip(result, totals):
+            if not weekday[0]:
+                continue
+            for i in range(4):
+                merged[i] += weekday[i]
+            for i in range(4, 10, 2):
+                if merged[i] is None or weekday[i] < merged[i]:
+                    merged[i] = weekday[i]
+                if merged[i + 1] is None or weekday[i + 1] > merged[i + 1]:
+                    merged[i + 1] = weekday[i + 1]
+    return tuple(tuple(weekday) for weekday in result)
+
+
+def precompute(store, users=None, previous=None):
+    """
+    Materializes weekday_totals() of every user of the store.
+
+    Only users in given collection are computed (all by default), totals of
+    the others are taken from previous precompute() result.
+    """
+    result = {}
+    for user_id in store.offsets:
+        if users is None or user_id in users or user_id not in previous:
+            result[user_id] = weekday_totals(*store.columns(user_id))
+        else:
+            result[user_id] = previous[user_id]
+    return result
+
+
+def _histogram(residues, values, low, high):
+    """
+    Counts values from [low, high) together with day % 7 residues.
+
+    Count of value v on days with residue r is at (v - low) * 7 + r. Every
+    step runs over whole columns in C, so the only Python loop is over
+    distinct values later on.
+    """
+    counts = [0] * ((high - low) * 7)
+    if low:
+        values = imap(sub, values, repeat(low))
+    keys = imap(add, imap(mul, values, repeat(7)), residues)
+    for key in keys:
+        counts[key] += 1
+    return counts
+
+
+def _describe_histogram(counts, low, percentiles):
+    """
+    Returns count, sum, mean, min, max and percentiles of values counted in
+    a histogram, like a single field of expand_totals().
+    """
+    values = list(compress(xrange(len(counts)), counts))
+    total = sum(counts)
+    stats = {
+        'count': total,
+        'sum': 0,
+        'mean': 0,
+        'min': values[0] + low if values else None,
+        'max': values[-1] + low if values else None,
+    }
+    wanted = sorted(
+        (min(int(total * value / 100.0), total - 1), value)
+        for value in percentiles
+    )
+    seen = 0
+    for value in values:
+        count = counts[value]
+        while wanted and wanted[0][0] < seen + count:
+            stats['p%d' % wanted.pop(0)[1]] = value + low
+        seen += count
+        stats['sum'] += (value + low) * count
+    for _, value in wanted:
+        stats['p%d' % value] = 0
+    if total:
+        stats['mean'] = float(stats['sum']) / total
+    return stats
+
+
+@timed('aggregate')
+def summarize(store, users=None, first=None, last=None,
+              percentiles=PERCENTILES):
+    """
+    Returns weekday statistics of many users together, like expand_totals()
+    plus 'p<N>' percentiles of every field and the number of 'users'.
+
+    Statistics of the whole history of given users (all by default) merge
+    their precomputed weekday totals and quantile sketches, in O(users)
+    whatever the number of rows; percentiles are then approximate, like
+    the ones of a single user, see sketch.QuantileSketch. Rows limited to
+    days from first to last are counted into exact, one-second histograms
+    per weekday instead, see _histogram().
+    """
+    user_ids = [
+        user_id for user_id in (store.keys() if users is None else users)
+        if user_id in store
+    ]
+    if first is None and last is None:
+        return _summarize_precomputed(store, user_ids, percentiles)
+    return _summarize_rows(store, user_ids, first, last, percentiles)
+
+
+def _summarize_precomputed(store, user_ids, percentiles):
+    """
+    Summarizes whole history of users from their totals and sketches.
+    """
+    # imported here, sketch depends on this module
+    from presence_analyzer.sketch import merge_sketches
+
+    totals = [store.weekday_totals(user_id) for user_id in user_ids]
+    sketches = [store.weekday_sketches(user_id) for user_id in user_ids]
+    result = expand_totals(merge_totals(totals))
+    for weekday, stats in enumerate(result):
+        stats['users'] = sum(1 for user in totals if user[weekday][0])
+        for i, field in enumerate(FIELDS):
+            merged = merge_sketches(user[weekday][i] for user in sketches)
+            for value in percentiles:
+                stats[field]['p%d' % value] = merged.quantile(value / 100.0)
+    return result
+
+
+def _summarize_rows(store, user_ids, first, last, percentiles):
+    """
+    Summarizes rows of users from first to last by exact histograms.
+    """
+    # imported here, store depends on this module
+    from presence_analyzer.store import COLUMN_TYPECODE
+
+    days, starts, ends = (array(COLUMN_TYPECODE) for _ in FIELDS)
+    present = [0] * 7
+    for user_id in user_ids:
+        user_days, user_starts, user_ends = store.columns(
+            user_id, first, last,
+        )
+        days.extend(user_days)
+        starts.extend(user_starts)
+        ends.extend(user_ends)
+        for residue in set(imap(mod, user_days, repeat(7))):
+            present[residue] += 1
+
+    residues = array(COLUMN_TYPECODE, imap(mod, days, repeat(7)))
+    del days
+    histograms = {
+        'duration': _histogram(
+            residues, imap(sub, ends, starts), -DAY_SECONDS, DAY_SECONDS,
+        ),
+        'start': _histogram(residues, starts, 0, DAY_SECONDS),
+        'end': _histogram(residues, ends, 0, DAY_SECONDS),
+    }
+
+    result = []
+    for weekday in range(7):
+        # day ordinal 1 is a Monday
+        residue = (weekday + 1) % 7
+        stats = {'users': present[residue]}
+        for field in FIELDS:
+            low = -DAY_SECONDS if field == 'duration' else 0
+            stats[field] = _describe_histogram(
+                histograms[field][residue::7], low, percentiles,
+            )
+        stats['count'] = stats['duration']['count']
+        result.append(stats)
+    return result
@@ -0,0 +1,784 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks and synthetic data generators.
+
+Run with: bin/python-console -m presence_analyzer.benchmarks --help
+"""
+
+import argparse
+import csv
+import datetime
+import functools
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from lxml import etree
+
+from presence_analyzer import binstore, main as app_main, utils, views
+from presence_analyzer.aggregates import summarize
+from presence_analyzer.csvparser import PresenceCSVParser
+from presence_analyzer.loader import PresenceCSVLoader
+from presence_analyzer.partitions import PartitionedCSVLoader
+from presence_analyzer.refresher import SnapshotCache
+from presence_analyzer.store import PresenceStoreBuilder
+
+
+def generate_presence_csv(path, users=100, years=1, seed=0):
+    """
+    Writes realistic presence CSV: one row per user per working day.
+
+    Returns number of written rows.
+    """
+    rnd = random.Random(seed)
+    first_day = datetime.date(2013, 1, 1).toordinal()
+    last_day = first_day + int(365 * years)
+    rows = 0
+    with open(path, 'w') as csvfile:
+        for user_id in xrange(1, users + 1):
+            for day in xrange(first_day, last_day):
+                if (day + 6) % 7 >= 5 or rnd.random() < 0.05:
+                    # weekends and days off
+                    continue
+                start = int(rnd.gauss(9 * 3600, 2700))
+                end = start + int(rnd.gauss(8 * 3600, 1800))
+                start = min(max(start, 0), 86399)
+                end = min(max(end, start), 86399)
+                csvfile.write('%d,%s,%02d:%02d:%02d,%02d:%02d:%02d\n' % (
+                    user_id,
+                    datetime.date.fromordinal(day).isoformat(),
+                    start // 3600, start // 60 % 60, start % 60,
+                    end // 3600, end // 60 % 60, end % 60,
+                ))
+                rows += 1
+    return rows
+
+
+def generate_users_xml(path, users=100, seed=0):
+    """
+    Writes users XML in the intranet export format.
+    """
+    rnd = random.Random(seed)
+    letters = 'ABCDEFGHIJKLMNOPRSTUWZ'
+    with open(path, 'w') as xmlfile:
+        xmlfile.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n<intranet>\n'
+            '    <server>\n'
+            '        <host>intranet.stxnext.pl</host>\n'
+            '        <port>443</port>\n'
+            '        <protocol>https</protocol>\n'
+            '    </server>\n    <users>\n'
+        )
+        for user_id in xrange(1, users + 1):
+            name = '%s%s %s.' % (
+                rnd.choice(letters),
+                ''.join(rnd.choice('aeiouklmnrst') for _ in range(5)),
+                rnd.choice(letters),
+            )
+            xmlfile.write(
+                '        <user id="%d">\n'
+                '            <avatar>/api/images/users/%d</avatar>\n'
+                '            <name>%s</name>\n'
+                '        </user>\n' % (user_id, user_id, name)
+            )
+        xmlfile.write('    </users>\n</intranet>\n')
+
+
+def deep_sizeof(obj, seen=None):
+    """
+    Approximates memory used by an object graph of builtin containers.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(
+            deep_sizeof(key, seen) + deep_sizeof(value, seen)
+            for key, value in obj.iteritems()
+        )
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    return size
+
+
+def load_dict_layout(path):
+    """
+    Loads CSV into the former nested dict layout of get_data().
+    """
+    data = {}
+    with open(path, 'r') as csvfile:
+        for row in csv.reader(csvfile):
+            if len(row) != 4:
+                continue
+            date = datetime.datetime.strptime(row[1], '%Y-%m-%d').date()
+            start = datetime.datetime.strptime(row[2], '%H:%M:%S').time()
+            end = datetime.datetime.strptime(row[3], '%H:%M:%S').time()
+            data.setdefault(int(row[0]), {})[date] = {
+                'start': start,
+                'end': end,
+            }
+    return data
+
+
+def bench_store_memory(path):
+    """
+    Compares memory used by the dict layout and by the PresenceStore.
+    """
+    started = time.time()
+    data = load_dict_layout(path)
+    dict_seconds = time.time() - started
+    rows = sum(len(dates) for dates in data.itervalues())
+    dict_bytes = deep_sizeof(data)
+    del data
+
+    started = time.time()
+    store = PresenceCSVLoader().load(path)
+    store_seconds = time.time() - started
+    store_bytes = store.nbytes() + deep_sizeof(store.offsets)
+
+    return {
+        'rows': rows,
+        'dict_bytes_per_row': float(dict_bytes) / rows,
+        'store_bytes_per_row': float(store_bytes) / rows,
+        'dict_load_seconds': dict_seconds,
+        'store_load_seconds': store_seconds,
+    }
+
+
+def load_store_strptime(path):
+    """
+    Loads CSV into a PresenceStore using csv.reader and strptime.
+    """
+    builder = PresenceStoreBuilder()
+    with open(path, 'r') as csvfile:
+        for row in csv.reader(csvfile):
+            if len(row) != 4:
+                continue
+            date = datetime.datetime.strptime(row[1], '%Y-%m-%d').date()
+            start = datetime.datetime.strptime(row[2], '%H:%M:%S').time()
+            end = datetime.datetime.strptime(row[3], '%H:%M:%S').time()
+            builder.add(
+                int(row[0]),
+                date.toordinal(),
+                utils.seconds_since_midnight(start),
+                utils.seconds_since_midnight(end),
+            )
+    return builder
+
+
+def bench_csv_parse(path):
+    """
+    Compares parsing throughput of strptime and of PresenceCSVParser.
+    """
+    started = time.time()
+    load_store_strptime(path)
+    strptime_seconds = time.time() - started
+
+    started = time.time()
+    builder = PresenceStoreBuilder()
+    with open(path, 'r') as csvfile:
+        rows = PresenceCSVParser().parse(csvfile, builder)
+    parser_seconds = time.time() - started
+
+    return {
+        'rows': rows,
+        'strptime_rows_per_second': rows / strptime_seconds,
+        'parser_rows_per_second': rows / parser_seconds,
+    }
+
+
+def bench_csv_append(path):
+    """
+    Compares full load of the CSV with a refresh after appending a row.
+    """
+    csv_loader = PresenceCSVLoader()
+    started = time.time()
+    csv_loader.load(path)
+    full_seconds = time.time() - started
+
+    with open(path, 'a') as csvfile:
+        csvfile.write('1,2030-01-01,09:00:00,17:00:00\n')
+    started = time.time()
+    store = csv_loader.load(path)
+    append_seconds = time.time() - started
+
+    return {
+        'rows': store.rows(),
+        'full_load_seconds': full_seconds,
+        'append_refresh_seconds': append_seconds,
+    }
+
+
+def _stress(path, get, threads=20, seconds=3.0, append_every=0.25):
+    """
+    Calls get() from many threads while rows are appended to path.
+
+    Returns latency percentiles in milliseconds.
+    """
+    latencies = []
+    deadline = time.time() + seconds
+
+    def reader():
+        """
+        Measures latency of get() until the deadline.
+        """
+        measured = []
+        while time.time() < deadline:
+            started = time.time()
+            get()
+            measured.append(time.time() - started)
+        latencies.extend(measured)
+
+    workers = [threading.Thread(target=reader) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    day = datetime.date(2030, 1, 1)
+    while time.time() < deadline:
+        time.sleep(append_every)
+        day += datetime.timedelta(days=1)
+        with open(path, 'a') as csvfile:
+            csvfile.write('1,%s,09:00:00,17:00:00\n' % day.isoformat())
+    for worker in workers:
+        worker.join()
+
+    latencies.sort()
+    return {
+        'calls': len(latencies),
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': latencies[-1] * 1000 if latencies else 0,
+    }
+
+
+def bench_refresh_stress(path):
+    """
+    Compares reader latency of the former global lock and SnapshotCache
+    while the CSV is appended to and refreshed.
+    """
+    lock = threading.Lock()
+    locked_loader = PresenceCSVLoader()
+
+    def locked_get():
+        """
+        Former behaviour: every reader takes the lock, one of them reloads.
+        """
+        with lock:
+            return locked_loader.load(path)
+
+    snapshot = SnapshotCache(
+        'bench', PresenceCSVLoader().load, utils.file_signature,
+    )
+    locked_get()
+    snapshot.get(path, 0.05)
+    result = {}
+    for name, value in _stress(path, locked_get).iteritems():
+        result['locked_' + name] = value
+    for name, value in _stress(
+            path, lambda: snapshot.get(path, 0.05)).iteritems():
+        result['snapshot_' + name] = value
+    return result
+
+
+def parse_users_tree(path):
+    """
+    Parses users XML the former way, loading the whole tree.
+    """
+    with open(path, 'r') as xmlfile:
+        tree = etree.parse(xmlfile)
+        server = tree.find('server')
+        host = server.find('host').text
+        protocol = server.find('protocol').text
+        return {
+            int(user.get('id')): {
+                'name': user.find('name').text,
+                'avatar': '{}://{}{}'.format(
+                    protocol, host, user.find('avatar').text,
+                ),
+            }
+            for user in tree.find('users')
+        }
+
+
+def parse_users_stream(path):
+    """
+    Parses users XML with the streaming parser.
+    """
+    with open(path, 'rb') as xmlfile:
+        return {
+            user_id: {'name': name, 'avatar': avatar}
+            for user_id, name, avatar in utils.iter_users_xml(xmlfile)
+        }
+
+
+def _peak_rss(function, path, queue):
+    """
+    Runs function(path) and puts peak resident memory (kB) into the queue.
+    """
+    if function is not None:
+        function(path)
+    queue.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def peak_rss(function, path):
+    """
+    Returns peak resident memory of a fresh process running function(path).
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=_peak_rss, args=(function, path, queue),
+    )
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def bench_users_xml_memory(users):
+    """
+    Compares peak memory of tree and streaming parsing of users XML.
+    """
+    handle, path = tempfile.mkstemp(suffix='.xml')
+    os.close(handle)
+    try:
+        generate_users_xml(path, users=users)
+        baseline = peak_rss(None, path)
+        return {
+            'users': users,
+            'tree_peak_kb': peak_rss(parse_users_tree, path) - baseline,
+            'stream_peak_kb': peak_rss(parse_users_stream, path) - baseline,
+        }
+    finally:
+        os.remove(path)
+
+
+def bench_snapshot_load(path):
+    """
+    Compares cold load of the CSV with mapping of its binary snapshot.
+    """
+    started = time.time()
+    store = PresenceCSVLoader().load(path)
+    csv_seconds = time.time() - started
+
+    snapshot_path = path + '.snapshot'
+    binstore.write_snapshot(store, snapshot_path)
+    try:
+        started = time.time()
+        snapshot = binstore.load_snapshot(snapshot_path)
+        for user_id in snapshot:
+            snapshot.weekday_stats(user_id)
+        snapshot_seconds = time.time() - started
+        snapshot_bytes = os.path.getsize(snapshot_path)
+    finally:
+        os.remove(snapshot_path)
+
+    return {
+        'rows': store.rows(),
+        'csv_load_seconds': csv_seconds,
+        'snapshot_load_seconds': snapshot_seconds,
+        'snapshot_bytes': snapshot_bytes,
+    }
+
+
+def summarize_legacy(data):
+    """
+    Summarizes durations of all users by calling group_by_weekday() per user.
+    """
+    weekdays = [[] for _ in range(7)]
+    for user_id in data:
+        grouped = utils.group_by_weekday(data[user_id])
+        for weekday, durations in grouped.items():
+            weekdays[weekday].extend(durations)
+    return [
+        [percentile(sorted(durations), 0.5)] for durations in weekdays
+    ]
+
+
+def bench_summary(path):
+    """
+    Compares organization-wide weekday summary with per-user grouping.
+    """
+    data = load_dict_layout(path)
+    started = time.time()
+    summarize_legacy(data)
+    legacy_seconds = time.time() - started
+    del data
+
+    store = PresenceCSVLoader().load(path)
+    started = time.time()
+    summarize(store)
+    store_seconds = time.time() - started
+    started = time.time()
+    summarize(store, first=store.days[0] if store.rows() else None)
+    range_seconds = time.time() - started
+
+    return {
+        'rows': store.rows(),
+        'legacy_seconds': legacy_seconds,
+        'summarize_seconds': store_seconds,
+        'summarize_range_seconds': range_seconds,
+    }
+
+
+def split_by_month(path, directory):
+    """
+    Splits presence CSV into one partition per month in directory.
+    """
+    partitions = {}
+    with open(path, 'r') as csvfile:
+        for line in csvfile:
+            month = line.split(',', 2)[1][:7]
+            if month not in partitions:
+                partitions[month] = open(
+                    os.path.join(directory, month + '.csv'), 'w',
+                )
+            partitions[month].write(line)
+    for partition in partitions.itervalues():
+        partition.close()
+    return len(partitions)
+
+
+def bench_partitions(path):
+    """
+    Compares serial and parallel load of monthly partitions and a reload
+    after one of them changed.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        count = split_by_month(path, directory)
+        started = time.time()
+        PartitionedCSVLoader(processes=1).load(directory)
+        serial_seconds = time.time() - started
+
+        loader = PartitionedCSVLoader()
+        started = time.time()
+        loader.load(directory)
+        parallel_seconds = time.time() - started
+
+        last = sorted(os.listdir(directory))[-1]
+        with open(os.path.join(directory, last), 'a') as partition:
+            partition.write('1,%s-28,09:00:00,17:00:00\n' % last[:7])
+        started = time.time()
+        loader.load(directory)
+        reload_seconds = time.time() - started
+    finally:
+        shutil.rmtree(directory)
+
+    return {
+        'partitions': count,
+        'processes': multiprocessing.cpu_count(),
+        'serial_load_seconds': serial_seconds,
+        'parallel_load_seconds': parallel_seconds,
+        'reload_one_seconds': reload_seconds,
+    }
+
+
+def percentile(values, fraction):
+    """
+    Returns value below which given fraction of sorted values falls.
+    """
+    if not values:
+        return 0
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def per_call(function, number):
+    """
+    Returns average seconds of number calls of function.
+    """
+    started = time.time()
+    for _ in xrange(number):
+        function()
+    return (time.time() - started) / number
+
+
+def configure_app(csv_path, xml_path):
+    """
+    Points the app at generated data and drops everything cached.
+    """
+    app_main.app.config.update({
+        'DATA_CSV': csv_path,
+        'DATA_XML': xml_path,
+        'DATA_SNAPSHOT': None,
+        'SHARED_DATA_DIR': None,
+    })
+    utils.PRESENCE_LOADER.reset()
+    for cache in utils.CACHES.values():
+        cache.clear()
+
+
+def bench_micro(csv_path, xml_path, number=1000):
+    """
+    Times get_data, group_by_weekday, parse_users_xml and cached_json.
+
+    cached_json misses compute and encode the response, hits return the
+    encoded one.
+
+    Cold timings include loading the files, warm ones are averages of
+    number calls served from memory. Results are in microseconds.
+    """
+    configure_app(csv_path, xml_path)
+    result = {}
+    started = time.time()
+    data = utils.get_data()
+    result['get_data_cold_us'] = (time.time() - started) * 1e6
+    result['get_data_warm_us'] = per_call(utils.get_data, number) * 1e6
+
+    user_id = data.keys()[len(data) // 2]
+    legacy = data[user_id]
+    result['group_by_weekday_us'] = per_call(
+        lambda: utils.group_by_weekday(legacy), number,
+    ) * 1e6
+    result['weekday_stats_us'] = per_call(
+        lambda: data.weekday_stats(user_id), number,
+    ) * 1e6
+
+    started = time.time()
+    utils.parse_users_xml()
+    result['parse_users_xml_cold_us'] = (time.time() - started) * 1e6
+    result['parse_users_xml_warm_us'] = per_call(
+        utils.parse_users_xml, number,
+    ) * 1e6
+
+    with app_main.app.test_request_context():
+        for name, view, args, calls in (
+                ('users', views.users_view, (), max(number // 10, 1)),
+                ('start_end', views.presence_start_end, (user_id,), number),
+        ):
+            result['cached_json_%s_miss_us' % name] = per_call(
+                lambda view=view, args=args: (view.cache.clear(), view(*args)),
+                calls,
+            ) * 1e6
+            result['cached_json_%s_hit_us' % name] = per_call(
+                lambda view=view, args=args: view(*args), number,
+            ) * 1e6
+    return result
+
+
+def _client_loop(urls, deadline, latencies, errors, seed):
+    """
+    Requests random urls through a test client until deadline.
+    """
+    rnd = random.Random(seed)
+    client = app_main.app.test_client()
+    while time.time() < deadline:
+        started = time.time()
+        response = client.get(rnd.choice(urls))
+        latencies.append(time.time() - started)
+        if response.status_code != 200:
+            errors.append(response.status_code)
+
+
+def bench_e2e(csv_path, xml_path, concurrency=(1, 4, 16), seconds=3.0):
+    """
+    Measures throughput and latency of API requests through
+    app.test_client() called from several threads at once.
+    """
+    configure_app(csv_path, xml_path)
+    data = utils.get_data()
+    users = data.keys()
+    urls = ['/api/v1/users', '/api/v1/presence_summary']
+    for user_id in users[:100]:
+        urls.extend([
+            '/api/v1/mean_time_weekday/%d' % user_id,
+            '/api/v1/presence_weekday/%d' % user_id,
+            '/api/v1/presence_start_end/%d' % user_id,
+            '/api/v1/presence_start_end/%d?stat=median' % user_id,
+        ])
+    client = app_main.app.test_client()
+    for url in urls:
+        client.get(url)
+
+    result = {}
+    for level in concurrency:
+        latencies = []
+        errors = []
+        deadline = time.time() + seconds
+        threads = [
+            threading.Thread(
+                target=_client_loop,
+                args=(urls, deadline, latencies, errors, seed),
+            )
+            for seed in range(level)
+        ]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+        latencies.sort()
+        prefix = 'c%d_' % level
+        result[prefix + 'requests_per_second'] = len(latencies) / elapsed
+        result[prefix + 'p50_ms'] = percentile(latencies, 0.5) * 1000
+        result[prefix + 'p99_ms'] = percentile(latencies, 0.99) * 1000
+        result[prefix + 'errors'] = len(errors)
+    return result
+
+
+BENCHMARKS = {
+    'csv-append': bench_csv_append,
+    'csv-parse': bench_csv_parse,
+    'partitions': bench_partitions,
+    'refresh-stress': bench_refresh_stress,
+    'snapshot-load': bench_snapshot_load,
+    'store-memory': bench_store_memory,
+    'summary': bench_summary,
+}
+
+# Benchmarks working on generated users XML of --users size.
+XML_BENCHMARKS = {
+    'users-xml-memory': bench_users_xml_memory,
+}
+
+# Benchmarks of the application, working on generated CSV and users XML.
+APP_BENCHMARKS = {
+    'e2e': bench_e2e,
+    'micro': bench_micro,
+}
+
+
+def run_on_generated_csv(benchmark, users, years):
+    """
+    Runs benchmark(path) on a temporary generated presence CSV.
+    """
+    handle, path = tempfile.mkstemp(suffix='.csv')
+    os.close(handle)
+    try:
+        generate_presence_csv(path, users=users, years=years)
+        return benchmark(path)
+    finally:
+        os.remove(path)
+
+
+def run_on_generated_data(benchmarks, users, years):
+    """
+    Runs benchmark(csv_path, xml_path) of every given benchmark on
+    temporary generated presence CSV and users XML.
+
+    Returns results of all benchmarks, prefixed with their names.
+    """
+    directory = tempfile.mkdtemp()
+    csv_path = os.path.join(directory, 'data.csv')
+    xml_path = os.path.join(directory, 'users.xml')
+    try:
+        generate_presence_csv(csv_path, users=users, years=years)
+        generate_users_xml(xml_path, users=users)
+        result = {}
+        for name, benchmark in benchmarks:
+            for key, value in benchmark(csv_path, xml_path).iteritems():
+                result['%s.%s' % (name, key)] = value
+        return result
+    finally:
+        shutil.rmtree(directory)
+
+
+def git_commit():
+    """
+    Returns the commit the benchmarked code comes from, if known.
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w'),
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(result, baseline):
+    """
+    Returns {name: value / baseline value} of results present in both.
+    """
+    return dict(
+        (name, float(value) / baseline[name])
+        for name, value in result.iteritems()
+        if isinstance(value, (int, float)) and baseline.get(name)
+    )
+
+
+def main(argv=None):
+    """
+    Runs selected benchmark on generated data.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        'benchmark',
+        choices=(
+            sorted(BENCHMARKS) + sorted(XML_BENCHMARKS) +
+            sorted(APP_BENCHMARKS) + ['suite']
+        ),
+        help='"suite" runs all application benchmarks',
+    )
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--years', type=float, default=1)
+    parser.add_argument(
+        '--concurrency', default='1,4,16',
+        help='comma separated numbers of concurrent e2e clients',
+    )
+    parser.add_argument(
+        '--seconds', type=float, default=3.0,
+        help='duration of every e2e concurrency level',
+    )
+    parser.add_argument('--output', help='file to save results as JSON')
+    parser.add_argument(
+        '--baseline', help='JSON file of earlier results to compare with',
+    )
+    args = parser.parse_args(argv)
+
+    if args.benchmark in XML_BENCHMARKS:
+        result = XML_BENCHMARKS[args.benchmark](args.users)
+    elif args.benchmark in BENCHMARKS:
+        result = run_on_generated_csv(
+            BENCHMARKS[args.benchmark], args.users, args.years,
+        )
+    else:
+        e2e = functools.partial(
+            bench_e2e,
+            concurrency=[int(level) for level in args.concurrency.split(',')],
+            seconds=args.seconds,
+        )
+        names = sorted(APP_BENCHMARKS)
+        if args.benchmark != 'suite':
+            names = [args.benchmark]
+        result = run_on_generated_data(
+            [(name, e2e if name == 'e2e' else APP_BENCHMARKS[name])
+             for name in names],
+            args.users, args.years,
+        )
+
+    ratios = {}
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            ratios = compare(result, json.load(baseline)['results'])
+    for name in sorted(result):
+        line = '%-40s %s' % (name, result[name])
+        if name in ratios:
+            line += '  (%.2fx baseline)' % ratios[name]
+        print line
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({
+                'benchmark': args.benchmark,
+                'users': args.users,
+                'years': args.years,
+                'commit': git_commit(),
+                'python': sys.version.split()[0],
+                'created': datetime.datetime.utcnow().isoformat(),
+                'results': result,
+            }, output, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Binary, memory-mappable snapshot of presence data.
+
+Layout (little-endian):
+    header      HEADER: magic, format version, users, rows, data version
+    index       users * INDEX_ENTRY: user_id, first row, end row
+    days        rows * int32, day ordinals
+    starts      rows * int32, seconds since midnight
+    ends        rows * int32, seconds since midnight
+    aggregates  users * 70 * int64, weekday_totals() in index order,
+                None stored as NONE
+
+Rows are sorted by user and day, exactly like in PresenceStore. Loaded
+snapshots are mapped read-only, so every process serving the same file
+shares its pages through the OS page cache, and only the parts which are
+actually read are ever loaded from disk.
+"""
+
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+
+from presence_analyzer.aggregates import TOTALS_LAYOUT, precompute
+from presence_analyzer.store import COLUMN_TYPECODE, PresenceStore
+
+MAGIC = 'PRESNAP\0'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sIII32s')
+INDEX_ENTRY = struct.Struct('<iII')
+COLUMN_ITEM = struct.Struct('<i')
+TOTALS = struct.Struct('<%dq' % (7 * len(TOTALS_LAYOUT)))
+# Stands for None in the aggregates section.
+NONE = -2 ** 63
+
+
+def _little_endian(column):
+    """
+    Returns column in little-endian byte order.
+    """
+    if sys.byteorder == 'big':
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column
+
+
+class MappedColumn(object):
+    """
+    Read-only int32 column stored inside a memory map.
+
+    Slices are decoded into arrays, so reading a user's rows copies only
+    those rows.
+    """
+
+    itemsize = COLUMN_ITEM.size
+
+    def __init__(self, buf, offset, length):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            lo, hi, step = index.indices(self.length)
+            if step != 1:
+                raise ValueError('Only contiguous slices are supported')
+            column = array(COLUMN_TYPECODE)
+            column.fromstring(self.buf[
+                self.offset + lo * self.itemsize:
+                self.offset + max(hi, lo) * self.itemsize
+            ])
+            return _little_endian(column)
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('column index out of range')
+        return COLUMN_ITEM.unpack_from(
+            self.buf, self.offset + index * self.itemsize
+        )[0]
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __eq__(self, other):
+        return self[:] == other[:]
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class MappedAggregates(object):
+    """
+    Read-only mapping of user_id to weekday_totals() inside a memory map.
+    """
+
+    def __init__(self, buf, offset, positions):
+        self.buf = buf
+        self.offset = offset
+        self.positions = positions
+
+    def __contains__(self, user_id):
+        return user_id in self.positions
+
+    def __getitem__(self, user_id):
+        values = TOTALS.unpack_from(
+            self.buf, self.offset + self.positions[user_id] * TOTALS.size
+        )
+        width = len(TOTALS_LAYOUT)
+        return tuple(
+            tuple(
+                None if value == NONE else value
+                for value in values[i:i + width]
+            )
+            for i in range(0, len(values), width)
+        )
+
+    def get(self, user_id, default=None):
+        """
+        Returns totals of given user or default.
+        """
+        if user_id not in self.positions:
+            return default
+        return self[user_id]
+
+    def keys(self):
+        """
+        Returns list of user ids.
+        """
+        return self.positions.keys()
+
+
+def write_snapshot(store, path):
+    """
+    Writes store into a snapshot file, replacing it atomically.
+    """
+    aggregates = store.aggregates
+    if aggregates is None:
+        aggregates = precompute(store)
+    users = store.keys()
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as snapshot:
+            snapshot.write(HEADER.pack(
+                MAGIC, FORMAT_VERSION, len(users), store.rows(),
+                store.version or '',
+            ))
+            for user_id in users:
+                lo, hi = store.offsets[user_id]
+                snapshot.write(INDEX_ENTRY.pack(user_id, lo, hi))
+            for column in (store.days, store.starts, store.ends):
+                _little_endian(column[:]).tofile(snapshot)
+            for user_id in users:
+                snapshot.write(TOTALS.pack(*(
+                    NONE if value is None else value
+                    for weekday in aggregates[user_id]
+                    for value in weekday
+                )))
+        os.chmod(temporary, 0644)
+        os.rename(temporary, path)
+    except Exception:
+        os.remove(temporary)
+        raise
+
+
+def load_snapshot(path):
+    """
+    Maps snapshot file into a read-only PresenceStore.
+    """
+    with open(path, 'rb') as snapshot:
+        buf = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(buf) < HEADER.size:
+        raise ValueError('Not a presence snapshot: %s' % path)
+    magic, format_version, users, rows, version = HEADER.unpack_from(buf)
+    if magic != MAGIC or format_version != FORMAT_VERSION:
+        raise ValueError('Not a presence snapshot: %s' % path)
+
+    offsets = {}
+    positions = {}
+    offset = HEADER.size
+    for position in xrange(users):
+        user_id, lo, hi = INDEX_ENTRY.unpack_from(buf, offset)
+        offsets[user_id] = (lo, hi)
+        positions[user_id] = position
+        offset += INDEX_ENTRY.size
+
+    columns = []
+    for _ in range(3):
+        columns.append(MappedColumn(buf, offset, rows))
+        offset += rows * COLUMN_ITEM.size
+    if len(buf) != offset + users * TOTALS.size:
+        raise ValueError('Truncated presence snapshot: %s' % path)
+
+    days, starts, ends = columns
+    return PresenceStore(
+        days, starts, ends, offsets,
+        version=version.rstrip('\0') or None,
+        aggregates=MappedAggregates(buf, offset, positions),
+    )
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Collation keys for sorting user names.
+"""
+
+import locale
+import logging
+import threading
+
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+POLISH_ALPHABET = u'aąbcćdeęfghijklłmnńoópqrsśtuvwxyzźż'
+_POLISH_ORDER = {letter: i for i, letter in enumerate(POLISH_ALPHABET)}
+
+_LOCK = threading.Lock()
+_SORT_KEYS = {}
+
+
+def polish_sort_key(text):
+    """
+    Approximates Polish collation: letters are compared case-insensitively
+    in the Polish alphabet order first, other characters are ignored unless
+    the letters are equal.
+    """
+    text = text if isinstance(text, unicode) else text.decode('utf-8')
+    primary = tuple(
+        _POLISH_ORDER.get(char, len(POLISH_ALPHABET) + ord(char))
+        for char in text.lower() if char.isalnum()
+    )
+    return primary, text
+
+
+def _strxfrm_key(text):
+    """
+    Returns locale.strxfrm() of text encoded as UTF-8.
+    """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return locale.strxfrm(text)
+
+
+def sort_key(locale_name):
+    """
+    Returns sort key function of given locale's collation.
+
+    LC_COLLATE is set at most once per process, so it's never mutated while
+    requests are served. When the locale isn't available, or LC_COLLATE is
+    already set to another one, polish_sort_key() is used instead.
+    """
+    with _LOCK:
+        if locale_name not in _SORT_KEYS:
+            current = locale.setlocale(locale.LC_COLLATE)
+            key = polish_sort_key
+            if current == locale_name:
+                key = _strxfrm_key
+            elif current in ('C', 'POSIX') and not _SORT_KEYS:
+                try:
+                    locale.setlocale(locale.LC_COLLATE, locale_name)
+                    key = _strxfrm_key
+                except locale.Error:
+                    log.warning(
+                        'Locale %s is not available, using built-in Polish '
+                        'collation', locale_name,
+                    )
+            _SORT_KEYS[locale_name] = key
+        return _SORT_KEYS[locale_name]
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Fast parser of presence CSV files.
+
+Rows look like ``user_id,YYYY-MM-DD,HH:MM:SS,HH:MM:SS``. Dates and times
+are decoded by slicing and integer arithmetic instead of
+datetime.strptime, and every distinct date or time string is decoded only
+once per parser since they repeat across users.
+"""
+
+import datetime
+import logging
+
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+def parse_day(text):
+    """
+    Converts 'YYYY-MM-DD' into proleptic Gregorian ordinal.
+    """
+    if len(text) != 10 or text[4] != '-' or text[7] != '-':
+        raise ValueError('Invalid date: %r' % text)
+    return datetime.date(
+        int(text[:4]), int(text[5:7]), int(text[8:])
+    ).toordinal()
+
+
+def parse_seconds(text):
+    """
+    Converts 'HH:MM:SS' into amount of seconds since midnight.
+    """
+    if len(text) != 8 or text[2] != ':' or text[5] != ':':
+        raise ValueError('Invalid time: %r' % text)
+    hour, minute, second = int(text[:2]), int(text[3:5]), int(text[6:])
+    if not (0 <= hour < 24 and 0 <= minute < 60 and 0 <= second < 60):
+        raise ValueError('Invalid time: %r' % text)
+    return hour * 3600 + minute * 60 + second
+
+
+class PresenceCSVParser(object):
+    """
+    Parses presence CSV lines into a PresenceStoreBuilder.
+
+    Lines which don't have exactly 4 columns (headers, footers) are skipped
+    silently, lines with malformed values are logged and skipped.
+    """
+
+    def __init__(self):
+        self._days = {}
+        self._seconds = {}
+
+    def day(self, text):
+        """
+        Memoized parse_day().
+        """
+        try:
+            return self._days[text]
+        except KeyError:
+            result = self._days[text] = parse_day(text)
+            return result
+
+    def seconds(self, text):
+        """
+        Memoized parse_seconds().
+        """
+        try:
+            return self._seconds[text]
+        except KeyError:
+            result = self._seconds[text] = parse_seconds(text)
+            return result
+
+    def parse(self, lines, builder, first_line=0):
+        """
+        Adds rows from iterable of lines to builder.
+
+        Returns number of added rows.
+        """
+        add = builder.add
+        day = self.day
+        seconds = self.seconds
+        rows = 0
+        for i, line in enumerate(lines, first_line):
+            row = line.rstrip('\r\n').split(',')
+            if len(row) != 4:
+                # ignore header and footer lines
+                continue
+
+            try:
+                add(int(row[0]), day(row[1]), seconds(row[2]), seconds(row[3]))
+            except (ValueError, TypeError):
+                log.debug('Problem with line %d: ', i, exc_info=True)
+                continue
+            rows += 1
+        return rows
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming export of presence data as CSV or newline-delimited JSON.
+"""
+
+import calendar
+import csv
+import datetime
+import StringIO
+from itertools import izip
+from json import dumps
+
+from presence_analyzer.aggregates import TOTALS_LAYOUT
+
+RAW_HEADER = ('user_id', 'date', 'start', 'end')
+WEEKDAY_HEADER = ('user_id', 'weekday') + TOTALS_LAYOUT
+
+
+def format_seconds(seconds):
+    """
+    Formats amount of seconds since midnight as HH:MM:SS.
+    """
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60,
+                               seconds % 60)
+
+
+def raw_rows(store, user_id, first=None, last=None):
+    """
+    Yields presence rows of given user in the DATA_CSV layout.
+    """
+    for day, start, end in izip(*store.columns(user_id, first, last)):
+        yield (
+            user_id,
+            datetime.date.fromordinal(day).isoformat(),
+            format_seconds(start),
+            format_seconds(end),
+        )
+
+
+def weekday_rows(store, user_id, first=None, last=None):
+    """
+    Yields weekday_totals() of given user, one row per weekday.
+    """
+    totals = store.weekday_totals(user_id, first, last)
+    for weekday, values in enumerate(totals):
+        yield (user_id, calendar.day_abbr[weekday]) + tuple(values)
+
+
+# Kinds of exported rows: header and rows of a single user.
+KINDS = {
+    'raw': (RAW_HEADER, raw_rows),
+    'weekday': (WEEKDAY_HEADER, weekday_rows),
+}
+
+
+def encode_csv(header, rows, with_header):
+    """
+    Encodes rows (and optionally the header) as CSV.
+    """
+    buf = StringIO.StringIO()
+    writer = csv.writer(buf, lineterminator='\n')
+    if with_header:
+        writer.writerow(header)
+    writer.writerows(rows)
+    return buf.getvalue()
+
+
+def encode_ndjson(header, rows, with_header):  # pylint: disable-msg=W0613
+    """
+    Encodes rows as JSON objects keyed by header, one per line.
+    """
+    return ''.join(dumps(dict(izip(header, row))) + '\n' for row in rows)
+
+
+# Export formats: content type and encoder.
+FORMATS = {
+    'csv': ('text/csv', encode_csv),
+    'ndjson': ('application/x-ndjson', encode_ndjson),
+}
+
+
+def export(store, user_ids, kind='raw', output='csv', first=None,
+           last=None):
+    """
+    Yields encoded rows of given users, one chunk per user.
+
+    Only a single user's rows are held in memory at once, so the memory
+    used doesn't depend on the size of the store. Unknown users are
+    skipped.
+    """
+    header, rows = KINDS[kind]
+    encode = FORMATS[output][1]
+    with_header = True
+    for user_id in user_ids:
+        if user_id not in store:
+            continue
+        chunk = encode(header, rows(store, user_id, first, last), with_header)
+        with_header = False
+        if chunk:
+            yield chunk
+    if with_header:
+        chunk = encode(header, [], with_header)
+        if chunk:
+            yield chunk
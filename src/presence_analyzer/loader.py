@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental loading of the append-only presence CSV file.
+"""
+
+import os
+
+from presence_analyzer import sketch
+from presence_analyzer.aggregates import precompute
+from presence_analyzer.csvparser import PresenceCSVParser
+from presence_analyzer.store import PresenceStoreBuilder
+
+# Amount of bytes before the read offset used to detect in-place rewrites.
+FINGERPRINT_SIZE = 64
+# Amount of bytes read from the file at once.
+CHUNK_SIZE = 1 << 20
+
+
+def file_signature(path):
+    """
+    Returns (path, device, inode, size, mtime) identifying file contents.
+    """
+    stat = os.stat(path)
+    return (path, stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
+
+
+def signature_version(signature):
+    """
+    Formats file_signature() as a short version string.
+    """
+    _, _, inode, size, mtime = signature
+    return '%x-%x-%x' % (inode, size, int(mtime * 1000))
+
+
+class PresenceCSVLoader(object):
+    """
+    Keeps a PresenceStore in sync with a CSV file that only grows.
+
+    The loader remembers file identity (device and inode), size, mtime and
+    the offset of the first byte it hasn't consumed yet. When the file
+    grew, only the appended tail is parsed and merged into a new store.
+    When it was truncated, replaced or rewritten, the whole file is
+    parsed again. Weekday totals and quantile sketches of users with new
+    rows are materialized into store.aggregates and store.sketches. Stores
+    are never modified once returned.
+    """
+
+    def __init__(self):
+        self.path = None
+        # (device, inode) of the loaded file
+        self.identity = None
+        self.size = 0
+        self.mtime = None
+        # offset of the first byte not consumed yet and lines before it
+        self.offset = 0
+        self.lines = 0
+        # bytes preceding offset, see _is_appended()
+        self.fingerprint = ''
+        self.store = None
+        self.parser = PresenceCSVParser()
+
+    def reset(self):
+        """
+        Forgets the loaded file, the next load() parses it from scratch.
+        """
+        self.path = None
+        self.identity = None
+        self.size = 0
+        self.mtime = None
+        self.offset = 0
+        self.lines = 0
+        self.fingerprint = ''
+        self.store = None
+        self.parser = PresenceCSVParser()
+
+    def load(self, path):
+        """
+        Returns PresenceStore of given file, parsing only appended rows.
+        """
+        try:
+            return self._load(path)
+        except Exception:
+            # state may be half-updated, start over next time
+            self.reset()
+            raise
+
+    def _load(self, path):
+        """
+        Brings the store up to date with given file.
+        """
+        with open(path, 'rb') as csvfile:
+            stat = os.fstat(csvfile.fileno())
+            if self._is_unchanged(path, stat):
+                return self.store
+
+            previous = None
+            if self._is_appended(path, stat, csvfile):
+                previous = self.store
+                builder = PresenceStoreBuilder.from_store(previous)
+            else:
+                self.reset()
+                self.path = path
+                self.identity = (stat.st_dev, stat.st_ino)
+                builder = PresenceStoreBuilder()
+
+            csvfile.seek(self.offset)
+            self.parser.parse(
+                self._read_lines(csvfile, stat.st_size),
+                builder,
+                first_line=self.lines,
+            )
+            self.size = stat.st_size
+            self.mtime = stat.st_mtime
+            self.fingerprint = self._read_fingerprint(csvfile)
+
+        store = builder.build(version=signature_version((
+            path, stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime,
+        )))
+        if previous is None:
+            store.aggregates = precompute(store)
+            store.sketches = sketch.precompute(store)
+        else:
+            store.aggregates = precompute(
+                store, builder.touched, previous.aggregates,
+            )
+            store.sketches = sketch.precompute(
+                store, builder.touched, previous.sketches, builder.appended(),
+            )
+        self.store = store
+        return store
+
+    def _read_lines(self, csvfile, end):
+        """
+        Yields lines between the current offset and end, advancing offset.
+
+        An unterminated last line is yielded as well but the offset stays
+        at its beginning, so it's parsed again once it's completed. Rows
+        of the same user and day replace each other, so it's harmless.
+        """
+        remainder = ''
+        position = self.offset
+        while position < end:
+            chunk = csvfile.read(min(CHUNK_SIZE, end - position))
+            if not chunk:
+                break
+            position += len(chunk)
+            lines = (remainder + chunk).split('\n')
+            remainder = lines.pop()
+            self.offset = position - len(remainder)
+            self.lines += len(lines)
+            for line in lines:
+                yield line
+        if remainder:
+            yield remainder
+
+    def _is_unchanged(self, path, stat):
+        """
+        Checks if file wasn't modified since the last load.
+        """
+        return (
+            self.store is not None and
+            path == self.path and
+            (stat.st_dev, stat.st_ino) == self.identity and
+            stat.st_size == self.size and
+            stat.st_mtime == self.mtime
+        )
+
+    def _is_appended(self, path, stat, csvfile):
+        """
+        Checks if file only grew since the last load.
+        """
+        return (
+            self.store is not None and
+            path == self.path and
+            (stat.st_dev, stat.st_ino) == self.identity and
+            stat.st_size > self.size and
+            self._read_fingerprint(csvfile) == self.fingerprint
+        )
+
+    def _read_fingerprint(self, csvfile):
+        """
+        Reads bytes preceding the current offset.
+        """
+        start = max(self.offset - FINGERPRINT_SIZE, 0)
+        csvfile.seek(start)
+        return csvfile.read(self.offset - start)
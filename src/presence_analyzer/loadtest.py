@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+Load test of the application served by the Paste HTTP server.
+
+Starts the app in the threaded Paste server configured like
+parts/etc/deploy.ini and replays a mix of API requests from many
+concurrent clients, reporting throughput and latency percentiles.
+
+Run with: bin/python-console -m presence_analyzer.loadtest --help
+"""
+
+import argparse
+import datetime
+import httplib
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+
+from presence_analyzer import benchmarks
+from presence_analyzer.benchmarks import percentile
+
+# Request paths of the mix, %(user_id)d is replaced by a random user.
+PATHS = {
+    'users': '/api/v1/users',
+    'mean_time_weekday': '/api/v1/mean_time_weekday/%(user_id)d',
+    'presence_weekday': '/api/v1/presence_weekday/%(user_id)d',
+    'presence_start_end': '/api/v1/presence_start_end/%(user_id)d',
+    'presence_summary': '/api/v1/presence_summary',
+}
+# Default weights of PATHS in the mix.
+MIX = 'users=1,mean_time_weekday=3,presence_weekday=3,presence_start_end=3'
+# Percentiles of latency reported per concurrency level.
+PERCENTILES = (50, 90, 99)
+# Configuration overrides of the started server: the load test must not
+# download users XML over DATA_XML nor load data before it's configured.
+APP_SETTINGS = {'XML_SYNC_INTERVAL': None, 'WARM_UP': False}
+
+
+def parse_mix(mix):
+    """
+    Parses "name=weight,..." into a list of (name, weight).
+    """
+    result = []
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in PATHS:
+            raise ValueError('Unknown request %r in mix' % name)
+        result.append((name, int(weight or 1)))
+    return result
+
+
+class RequestMix(object):
+    """
+    Draws request paths by weight of their names, for random users.
+    """
+
+    def __init__(self, weights, user_ids):
+        self.names = []
+        for name, weight in weights:
+            self.names.extend([name] * weight)
+        self.user_ids = list(user_ids)
+
+    def path(self, rnd):
+        """
+        Returns a random request path.
+        """
+        name = rnd.choice(self.names)
+        if '%(user_id)' in PATHS[name] and not self.user_ids:
+            name = 'users'
+        user_id = rnd.choice(self.user_ids) if self.user_ids else 0
+        return PATHS[name] % {'user_id': user_id}
+
+
+def serve(app, host='127.0.0.1', port=0, workers=50, spawn_if_under=5,
+          max_requests=200):
+    """
+    Serves app by the Paste HTTP server in a background thread.
+
+    The thread pool takes the options of parts/etc/deploy.ini,
+    spawn_if_under is capped at workers as the pool requires. Returns the
+    server, its port is server.server_port; stop it with shutdown().
+    """
+    from paste import httpserver
+    server = httpserver.serve(
+        app, host=host, port=str(port), start_loop=False,
+        use_threadpool=True, threadpool_workers=workers,
+        threadpool_options={
+            'spawn_if_under': min(spawn_if_under, workers),
+            'max_requests': max_requests,
+        },
+    )
+    server.thread = threading.Thread(
+        target=server.serve_forever, name='paste',
+    )
+    server.thread.daemon = True
+    server.thread.start()
+    return server
+
+
+def shutdown(server):
+    """
+    Stops server started by serve() and its thread pool.
+
+    Paste's serve_forever() doesn't support shutdown(), it handles requests
+    while server.running is set. The flag is cleared and the loop, waiting
+    for a connection, is woken by one; the loop then shuts the pool down.
+    """
+    server.running = False
+    try:
+        socket.create_connection(server.server_address[:2], 1).close()
+    except socket.error:
+        # the loop also wakes up every second to check server.running
+        pass
+    server.thread.join()
+    server.server_close()
+
+
+class Client(threading.Thread):
+    """
+    Sends requests of the mix one after another until the deadline.
+
+    Latencies (in seconds) of successful requests are appended to
+    latencies, statuses or exceptions of failed ones to errors.
+    """
+
+    def __init__(self, url, mix, deadline, seed):
+        super(Client, self).__init__(name='client-%d' % seed)
+        self.daemon = True
+        parts = urlparse.urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.prefix = parts.path.rstrip('/')
+        self.mix = mix
+        self.deadline = deadline
+        self.rnd = random.Random(seed)
+        self.latencies = []
+        self.errors = []
+
+    def run(self):
+        """
+        Sends requests over one connection until the deadline.
+        """
+        connection = httplib.HTTPConnection(self.host, self.port, timeout=30)
+        try:
+            while time.time() < self.deadline:
+                self.request(connection, self.prefix + self.mix.path(self.rnd))
+        finally:
+            connection.close()
+
+    def request(self, connection, path):
+        """
+        Sends a request, reads its response and records the outcome.
+        """
+        started = time.time()
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.read()
+        except (httplib.HTTPException, IOError) as error:
+            connection.close()
+            self.errors.append(type(error).__name__)
+            return
+        if response.status == 200:
+            self.latencies.append(time.time() - started)
+        else:
+            self.errors.append(response.status)
+
+
+def run_level(url, mix, clients, seconds):
+    """
+    Runs given number of concurrent clients for seconds.
+
+    Returns {'clients', 'requests', 'errors', 'requests_per_second',
+    'p50_ms', ..., 'max_ms'}.
+    """
+    deadline = time.time() + seconds
+    threads = [
+        Client(url, mix, deadline, seed) for seed in range(clients)
+    ]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    latencies = sorted(
+        latency for thread in threads for latency in thread.latencies
+    )
+    errors = sum(len(thread.errors) for thread in threads)
+    result = {
+        'clients': clients,
+        'requests': len(latencies),
+        'errors': errors,
+        'requests_per_second': len(latencies) / elapsed,
+    }
+    for number in PERCENTILES:
+        result['p%d_ms' % number] = (
+            percentile(latencies, number / 100.0) * 1000
+            if latencies else None
+        )
+    result['max_ms'] = latencies[-1] * 1000 if latencies else None
+    return result
+
+
+def user_ids_of(url):
+    """
+    Returns ids of users listed by the server at url.
+    """
+    parts = urlparse.urlsplit(url)
+    connection = httplib.HTTPConnection(
+        parts.hostname, parts.port or 80, timeout=60,
+    )
+    try:
+        connection.request('GET', parts.path.rstrip('/') + PATHS['users'])
+        response = connection.getresponse()
+        if response.status != 200:
+            raise IOError('Listing users failed: %d' % response.status)
+        return [user_id for user_id, _ in json.loads(response.read())]
+    finally:
+        connection.close()
+
+
+def format_level(result):
+    """
+    Formats result of run_level() as a report line.
+    """
+    def milliseconds(value):
+        """
+        Formats latency, which is None if no request succeeded.
+        """
+        return '%8s' % '-' if value is None else '%8.1f' % value
+
+    return '%7d %9d %7d %9.1f %s %s' % (
+        result['clients'], result['requests'], result['errors'],
+        result['requests_per_second'],
+        ' '.join(
+            milliseconds(result['p%d_ms' % number])
+            for number in PERCENTILES
+        ),
+        milliseconds(result['max_ms']),
+    )
+
+
+def report_header():
+    """
+    Returns header of format_level() lines.
+    """
+    return '%7s %9s %7s %9s %s %8s' % (
+        'clients', 'requests', 'errors', 'req/s',
+        ' '.join('%8s' % ('p%d ms' % number) for number in PERCENTILES),
+        'max ms',
+    )
+
+
+def main(argv=None):
+    """
+    Serves the app and runs the load test at every concurrency level.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--url',
+        help='load test a running server instead of starting one',
+    )
+    parser.add_argument(
+        '--config',
+        help='application configuration of the started server, '
+             'parts/etc/deploy.cfg by default',
+    )
+    parser.add_argument(
+        '--users', type=int,
+        help='serve generated data of this many users instead of the '
+             'configured data',
+    )
+    parser.add_argument('--years', type=float, default=1)
+    parser.add_argument('--workers', type=int, default=50)
+    parser.add_argument('--spawn-if-under', type=int, default=5)
+    parser.add_argument('--max-requests', type=int, default=200)
+    parser.add_argument(
+        '--clients', default='1,10,50,100',
+        help='comma separated numbers of concurrent clients',
+    )
+    parser.add_argument(
+        '--seconds', type=float, default=10.0,
+        help='duration of every concurrency level',
+    )
+    parser.add_argument(
+        '--mix', default=MIX,
+        help='comma separated request=weight, requests: %s' % ', '.join(
+            sorted(PATHS)
+        ),
+    )
+    parser.add_argument('--output', help='file to save results as JSON')
+    args = parser.parse_args(argv)
+    weights = parse_mix(args.mix)
+
+    server = directory = None
+    url = args.url
+    try:
+        if url is None:
+            from presence_analyzer import script
+            app = script.make_app(
+                config=args.config or script.DEPLOY_CFG,
+                settings=APP_SETTINGS,
+            )
+            if args.users:
+                directory = tempfile.mkdtemp()
+                csv_path = os.path.join(directory, 'data.csv')
+                xml_path = os.path.join(directory, 'users.xml')
+                benchmarks.generate_presence_csv(
+                    csv_path, users=args.users, years=args.years,
+                )
+                benchmarks.generate_users_xml(xml_path, users=args.users)
+                benchmarks.configure_app(csv_path, xml_path)
+            server = serve(
+                app,
+                workers=args.workers,
+                spawn_if_under=args.spawn_if_under,
+                max_requests=args.max_requests,
+            )
+            url = 'http://127.0.0.1:%d' % server.server_port
+
+        # The first listing also loads data, so it's not measured.
+        mix = RequestMix(weights, user_ids_of(url))
+        print report_header()
+        results = []
+        for clients in args.clients.split(','):
+            result = run_level(url, mix, int(clients), args.seconds)
+            results.append(result)
+            print format_level(result)
+            sys.stdout.flush()
+    finally:
+        if server is not None:
+            shutdown(server)
+        if directory is not None:
+            shutil.rmtree(directory)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({
+                'url': url,
+                'workers': args.workers,
+                'spawn_if_under': min(args.spawn_if_under, args.workers),
+                'max_requests': args.max_requests,
+                'mix': dict(weights),
+                'commit': benchmarks.git_commit(),
+                'python': sys.version.split()[0],
+                'created': datetime.datetime.utcnow().isoformat(),
+                'results': results,
+            }, output, indent=2, sort_keys=True)
+    return results
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded, thread-safe LRU cache with usage counters.
+"""
+
+import sys
+import threading
+from collections import OrderedDict
+
+
+def approximate_size(obj):
+    """
+    Approximates memory used by obj and builtin containers inside of it.
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(
+            approximate_size(key) + approximate_size(value)
+            for key, value in obj.iteritems()
+        )
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(approximate_size(item) for item in obj)
+    return size
+
+
+class LRUCache(object):
+    """
+    Mapping which evicts least recently used entries.
+
+    Entries are evicted when there are more than max_entries of them or when
+    their approximate size exceeds max_bytes. None disables a bound.
+    """
+
+    def __init__(self, name, max_entries=None, max_bytes=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """
+        Returns value stored under key, or default.
+        """
+        with self.lock:
+            try:
+                value, size = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """
+        Stores value under key, evicting least recently used entries.
+        """
+        size = approximate_size(value) if self.max_bytes is not None else 0
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.nbytes += size
+            while self.entries and (
+                    (self.max_entries is not None and
+                     len(self.entries) > self.max_entries) or
+                    (self.max_bytes is not None and
+                     self.nbytes > self.max_bytes)):
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.nbytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Removes all entries, counters are kept.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """
+        Returns usage counters.
+        """
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.nbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
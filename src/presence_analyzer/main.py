@@ -8,4 +8,33 @@ from flask.ext.mako import MakoTemplates
 
 
 app = Flask(__name__)  # pylint: disable-msg=C0103
+app.config.update(
+    # binary snapshot of DATA_CSV served instead of it, see binstore
+    DATA_SNAPSHOT=None,
+    # directory through which processes share presence data, see shared
+    SHARED_DATA_DIR=None,
+    # seconds between checks whether data files have changed
+    CACHE_CHECK_INTERVAL=1,
+    # collation of the users listing
+    USERS_LOCALE='pl_PL.UTF-8',
+    # seconds between downloads of users XML, None disables them
+    XML_SYNC_INTERVAL=None,
+    # directory of collapsed stacks of profiled requests, None disables
+    # profiling, see profiling
+    PROFILE_DIR=None,
+    # fraction of requests profiled
+    PROFILE_SAMPLE_RATE=0,
+    # requests sent with this header (e.g. 'X-Profile') are profiled, None
+    # disables it; anyone can send it, so enable it only where that's fine
+    PROFILE_HEADER=None,
+    # seconds between stack samples of a profiled request
+    PROFILE_INTERVAL=0.001,
+    # load data sources when the app is created, not on the first request
+    WARM_UP=False,
+    # app creation waits for warm-up, otherwise it runs in the background
+    # and /ready reports when it's done
+    WARM_UP_WAIT=True,
+    # responses computed and cached by warm-up, once data sources are loaded
+    WARM_UP_URLS=('/api/v1/users', '/api/v1/presence_summary'),
+)
 mako = MakoTemplates(app)
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight timers and counters exposed in Prometheus text format.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+# Upper bounds of histogram buckets in seconds.
+BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+# Content type of render() output.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(names, values, extra=()):
+    """
+    Formats label names and values as {name="value",...}.
+    """
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (
+            name,
+            unicode(value).replace('\\', '\\\\').replace('"', '\\"'),
+        )
+        for name, value in pairs
+    )
+
+
+def format_value(value):
+    """
+    Formats sample value.
+    """
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Timer(object):
+    """
+    Context manager observing its duration in a histogram.
+    """
+
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.started, *self.labels)
+
+
+class Histogram(object):
+    """
+    Counts observed values in cumulative buckets, per label values.
+
+    Observing takes a bisect and a short critical section, so it's cheap
+    enough to stay enabled on every request.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # label values: [bucket counts..., +Inf count, sum]
+        self.series = {}
+
+    def observe(self, value, *labels):
+        """
+        Records value for given label values.
+        """
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def time(self, *labels):
+        """
+        Returns context manager observing duration of its block.
+        """
+        return Timer(self, labels)
+
+    def count(self, *labels):
+        """
+        Returns number of values observed for given label values.
+        """
+        with self.lock:
+            series = self.series.get(labels)
+            return sum(series[:-1]) if series else 0
+
+    def samples(self):
+        """
+        Yields (suffix, label pairs, value) of every series.
+        """
+        with self.lock:
+            series = sorted(
+                (labels, list(values))
+                for labels, values in self.series.iteritems()
+            )
+        for labels, values in series:
+            total = 0
+            bounds = [repr(bound) for bound in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, values):
+                total += count
+                yield '_bucket', labels, (('le', bound),), total
+            yield '_sum', labels, (), values[-1]
+            yield '_count', labels, (), total
+
+
+class Counter(object):
+    """
+    Monotonic counter per label values.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def inc(self, *labels):
+        """
+        Increments the counter of given label values.
+        """
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + 1
+
+    def samples(self):
+        """
+        Yields (suffix, label pairs, value) of every series.
+        """
+        with self.lock:
+            series = sorted(self.series.items())
+        for labels, value in series:
+            yield '', labels, (), value
+
+
+class Collected(object):
+    """
+    Metric whose samples are read from collect() when rendered.
+
+    collect() returns {label values: value}.
+    """
+
+    def __init__(self, name, documentation, labels, collect,
+                 kind='gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.collect = collect
+        self.kind = kind
+
+    def samples(self):
+        """
+        Yields (suffix, label pairs, value) of every collected series.
+        """
+        for labels, value in sorted(self.collect().items()):
+            yield '', labels, (), value
+
+
+class Registry(object):
+    """
+    Ordered collection of metrics rendered together.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        """
+        Adds metric to the registry and returns it.
+        """
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Returns all metrics in Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for suffix, labels, extra, value in metric.samples():
+                lines.append('%s%s%s %s' % (
+                    metric.name, suffix,
+                    format_labels(metric.labels, labels, extra),
+                    format_value(value),
+                ))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'presence_request_duration_seconds',
+    'Time spent handling requests, by endpoint.',
+    labels=('endpoint',),
+))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'presence_stage_duration_seconds',
+    'Time spent in request stages: aggregation and JSON encoding.',
+    labels=('stage',),
+))
+LOAD_SECONDS = REGISTRY.register(Histogram(
+    'presence_load_duration_seconds',
+    'Time spent loading or reloading cached data sources, by cache.',
+    labels=('cache',),
+))
+LOCK_WAIT_SECONDS = REGISTRY.register(Histogram(
+    'presence_lock_wait_seconds',
+    'Time spent waiting for the load lock of a cache, by cache.',
+    labels=('cache',),
+))
+LOAD_FAILURES = REGISTRY.register(Counter(
+    'presence_load_failures_total',
+    'Number of failed background reloads, by cache.',
+    labels=('cache',),
+))
+
+
+def timed(stage):
+    """
+    Observes duration of every call in STAGE_SECONDS as given stage.
+    """
+    def _timed(function):
+        @wraps(function)
+        def inner(*args, **kwargs):
+            """
+            Calls the function and records its duration.
+            """
+            started = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                STAGE_SECONDS.observe(time.time() - started, stage)
+        return inner
+    return _timed
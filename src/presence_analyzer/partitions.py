@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Loading of presence data split into many CSV files.
+"""
+
+import glob
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+
+from presence_analyzer import sketch
+from presence_analyzer.aggregates import precompute
+from presence_analyzer.csvparser import PresenceCSVParser
+from presence_analyzer.loader import PresenceCSVLoader
+from presence_analyzer.store import PresenceStoreBuilder
+
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+# Partitions matched in a directory given as the data source.
+PARTITION_PATTERN = '*.csv'
+
+
+def is_partitioned(path):
+    """
+    Tells if path stands for many CSV files: a directory or a glob pattern.
+    """
+    return os.path.isdir(path) or glob.has_magic(path)
+
+
+def partition_paths(path):
+    """
+    Returns sorted paths of CSV files in a directory or matching a pattern.
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, PARTITION_PATTERN)
+    return sorted(
+        partition for partition in glob.glob(path)
+        if os.path.isfile(partition)
+    )
+
+
+def partition_signature(path):
+    """
+    Returns (device, inode, size, mtime) identifying file contents.
+    """
+    stat = os.stat(path)
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
+
+
+def source_signature(path):
+    """
+    Returns signature of a CSV file or of all its partitions.
+    """
+    if is_partitioned(path):
+        return (path, tuple(
+            (partition,) + partition_signature(partition)
+            for partition in partition_paths(path)
+        ))
+    return (path,) + partition_signature(path)
+
+
+def parse_partition(path):
+    """
+    Parses a single partition into a PresenceStore (in a worker process).
+    """
+    builder = PresenceStoreBuilder()
+    with open(path, 'rb') as csvfile:
+        PresenceCSVParser().parse(csvfile, builder)
+    return builder.build()
+
+
+class PartitionedCSVLoader(object):
+    """
+    Keeps a PresenceStore in sync with presence CSV partitions.
+
+    The source is a directory of CSV files or a glob pattern, e.g. one file
+    per month. Partitions which are new or changed (by inode, size or
+    mtime) are parsed in parallel by a pool of processes, the others are
+    reused from the previous load; rows of all partitions are then merged
+    in path order, so a later partition wins when two of them have the
+    same user and day. Weekday totals and sketches are recomputed only for
+    users of changed or removed partitions. A source which is a single file
+    is loaded by PresenceCSVLoader instead, parsing only appended rows.
+
+    Forking a process which runs other threads can deadlock the children
+    on a lock one of those threads held, e.g. the logging lock. Reloads
+    run in the background refresh thread of SnapshotCache, so the pool is
+    meant to be created once by start() before the server starts its
+    threads, and reused. Without it, partitions are parsed in a temporary
+    pool only while no other thread runs, otherwise one by one.
+    """
+
+    def __init__(self, processes=None):
+        self.processes = processes
+        self.file_loader = PresenceCSVLoader()
+        self.pool = None
+        self.path = None
+        # partition path: (partition_signature(), PresenceStore)
+        self.partitions = {}
+        self.store = None
+
+    def start(self):
+        """
+        Creates the pool of processes parsing partitions, if not created yet.
+
+        Call it while the process runs a single thread, see above.
+        """
+        if self.pool is None and self.processes != 1:
+            self.pool = multiprocessing.Pool(self.processes)
+
+    def close(self):
+        """
+        Stops the pool created by start().
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def reset(self):
+        """
+        Forgets the loaded source, the next load() parses it from scratch.
+        """
+        self.file_loader.reset()
+        self.path = None
+        self.partitions = {}
+        self.store = None
+
+    def load(self, path):
+        """
+        Returns PresenceStore of given source, parsing only what changed.
+        """
+        if not is_partitioned(path):
+            return self.file_loader.load(path)
+        try:
+            return self._load(path)
+        except Exception:
+            self.reset()
+            raise
+
+    def _load(self, path):
+        """
+        Brings the store up to date with partitions of given source.
+        """
+        if path != self.path:
+            self.reset()
+            self.path = path
+        signatures = dict(
+            (partition, partition_signature(partition))
+            for partition in partition_paths(path)
+        )
+        changed = sorted(
+            partition for partition, signature in signatures.iteritems()
+            if self.partitions.get(partition, (None,))[0] != signature
+        )
+        removed = [
+            partition for partition in self.partitions
+            if partition not in signatures
+        ]
+        if self.store is not None and not changed and not removed:
+            return self.store
+
+        affected = set()
+        for partition in changed + removed:
+            if partition in self.partitions:
+                affected.update(self.partitions.pop(partition)[1].offsets)
+        for partition, store in zip(changed, self._parse(changed)):
+            self.partitions[partition] = (signatures[partition], store)
+            affected.update(store.offsets)
+        log.debug(
+            'Parsed %d of %d partitions of %s',
+            len(changed), len(signatures), path,
+        )
+
+        builder = PresenceStoreBuilder()
+        for partition in sorted(self.partitions):
+            store = self.partitions[partition][1]
+            for user_id in store.offsets:
+                builder.extend(user_id, *store.columns(user_id))
+        store = builder.build(version=hashlib.md5(
+            repr(sorted(signatures.items()))
+        ).hexdigest()[:16])
+
+        previous = self.store
+        if previous is None:
+            store.aggregates = precompute(store)
+            store.sketches = sketch.precompute(store)
+        else:
+            store.aggregates = precompute(
+                store, affected, previous.aggregates,
+            )
+            store.sketches = sketch.precompute(
+                store, affected, previous.sketches,
+            )
+        self.store = store
+        return store
+
+    def _parse(self, paths):
+        """
+        Returns parse_partition() of given paths, in parallel if many and
+        forking is safe.
+        """
+        if len(paths) < 2 or self.processes == 1:
+            return [parse_partition(path) for path in paths]
+        if self.pool is not None:
+            return self.pool.map(parse_partition, paths, chunksize=1)
+        if threading.active_count() > 1:
+            log.debug('Parsing %d partitions serially, no pool', len(paths))
+            return [parse_partition(path) for path in paths]
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            return pool.map(parse_partition, paths, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
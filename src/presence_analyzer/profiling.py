@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Sampling profiler of selected requests, writing collapsed stacks.
+"""
+
+import logging
+import os
+import random
+import sys
+import thread
+import threading
+import time
+from collections import defaultdict
+
+from werkzeug.exceptions import HTTPException
+
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+def frame_name(frame):
+    """
+    Returns name of a stack frame in collapsed stacks.
+    """
+    code = frame.f_code
+    return '%s (%s:%d)' % (
+        code.co_name,
+        os.path.basename(code.co_filename),
+        code.co_firstlineno,
+    )
+
+
+def collapse(frame):
+    """
+    Returns stack of frame, outermost first, joined by semicolons.
+    """
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame).replace(';', ':'))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StackSampler(object):
+    """
+    Samples the stack of one thread from a background thread.
+
+    Every interval seconds the current stack of the thread is collapsed and
+    counted, so the counts approximate time spent in every call path.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = defaultdict(int)
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """
+        Starts sampling.
+        """
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='profiler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops sampling and returns {collapsed stack: samples}.
+        """
+        self.running = False
+        self.thread.join()
+        return dict(self.counts)
+
+    def _run(self):
+        """
+        Sampling loop.
+        """
+        while self.running:
+            frame = sys._current_frames().get(  # pylint: disable-msg=W0212
+                self.thread_id,
+            )
+            if frame is not None:
+                self.counts[collapse(frame)] += 1
+            del frame
+            time.sleep(self.interval)
+
+
+class ProfilingMiddleware(object):
+    """
+    WSGI middleware profiling sampled or header-flagged requests.
+
+    A request is profiled when the header is present (if configured) or
+    with probability sample_rate. Samples of every profiled request are
+    appended to ``profile-<endpoint>.folded`` in directory, one
+    "frame;frame;frame count" line per distinct stack, which is the input
+    format of flamegraph.pl. Requests which aren't profiled only pay for a
+    header lookup and a random number. Bodies streamed after the
+    application returned aren't profiled.
+    """
+
+    def __init__(self, app, wsgi_app, directory, sample_rate=0,
+                 header=None, interval=0.001):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.environ_key = None
+        if header:
+            self.environ_key = 'HTTP_' + header.upper().replace('-', '_')
+        self.interval = interval
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        profiled = (
+            self.environ_key is not None and self.environ_key in environ or
+            self.sample_rate and random.random() < self.sample_rate
+        )
+        if not profiled:
+            return self.wsgi_app(environ, start_response)
+
+        sampler = StackSampler(thread.get_ident(), self.interval)
+        sampler.start()
+        try:
+            return self.wsgi_app(environ, start_response)
+        finally:
+            self.write(self.endpoint(environ), sampler.stop())
+
+    def endpoint(self, environ):
+        """
+        Returns name of the endpoint handling the request.
+        """
+        try:
+            return self.app.url_map.bind_to_environ(environ).match()[0]
+        except HTTPException:
+            return 'unknown'
+
+    def path(self, endpoint):
+        """
+        Returns path of the collapsed stacks of given endpoint.
+        """
+        return os.path.join(self.directory, 'profile-%s.folded' % endpoint)
+
+    def write(self, endpoint, counts):
+        """
+        Appends collapsed stacks of a request to the endpoint's file.
+        """
+        lines = ''.join(
+            '%s %d\n' % (stack, count) for stack, count in counts.iteritems()
+        )
+        try:
+            with self.lock:
+                with open(self.path(endpoint), 'a') as folded:
+                    folded.write(lines)
+        except IOError:
+            log.exception('Writing profile of %s failed', endpoint)
+
+
+def install(app):
+    """
+    Wraps app.wsgi_app in ProfilingMiddleware if app.config['PROFILE_DIR']
+    is set, otherwise (and if it's already wrapped) does nothing.
+    """
+    config = app.config
+    if (not config.get('PROFILE_DIR') or
+            isinstance(app.wsgi_app, ProfilingMiddleware)):
+        return
+    app.wsgi_app = ProfilingMiddleware(
+        app,
+        app.wsgi_app,
+        config['PROFILE_DIR'],
+        sample_rate=config.get('PROFILE_SAMPLE_RATE', 0),
+        header=config.get('PROFILE_HEADER'),
+        interval=config.get('PROFILE_INTERVAL', 0.001),
+    )
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Lock-free snapshot cache refreshed in the background.
+"""
+
+import logging
+import threading
+import time
+
+from presence_analyzer import metrics
+
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+class SnapshotCache(object):
+    """
+    Holds the latest result of load(key) and refreshes it in the background.
+
+    Readers never wait for a lock once the first snapshot of a key exists:
+    they get the current snapshot, and when check_interval has elapsed one
+    of them starts a background thread which compares signature(key) with
+    the signature of the snapshot and, if it differs, loads a new snapshot
+    and swaps it in. Concurrent refreshes are coalesced into one. Only the
+    very first load of a key blocks the readers of that key.
+    """
+
+    def __init__(self, name, load, signature):
+        self.name = name
+        self.load = load
+        self.signature = signature
+        # (key, signature, result), replaced as a whole
+        self.current = None
+        self.next_check = 0
+        self.load_lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.thread = None
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def get(self, key, check_interval):
+        """
+        Returns the current snapshot for key, scheduling a refresh if due.
+        """
+        current = self.current
+        if current is None or current[0] != key:
+            return self._load(key, check_interval)
+
+        now = time.time()
+        if now >= self.next_check and self.refresh_lock.acquire(False):
+            self.next_check = now + check_interval
+            thread = threading.Thread(
+                target=self._refresh,
+                args=(current,),
+                name='refresh-{}'.format(self.name),
+            )
+            thread.daemon = True
+            self.thread = thread
+            thread.start()
+        self.hits += 1
+        return current[2]
+
+    def wait(self):
+        """
+        Waits until the refresh in progress, if any, is finished.
+        """
+        thread = self.thread
+        if thread is not None:
+            thread.join()
+
+    def clear(self):
+        """
+        Drops the current snapshot, the next get() loads a new one.
+        """
+        self.current = None
+
+    def stats(self):
+        """
+        Returns usage counters.
+        """
+        return {
+            'entries': int(self.current is not None),
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+        }
+
+    def _load(self, key, check_interval):
+        """
+        Loads the first snapshot of key, blocking until it's ready.
+        """
+        with metrics.LOCK_WAIT_SECONDS.time(self.name):
+            self.load_lock.acquire()
+        try:
+            current = self.current
+            if current is not None and current[0] == key:
+                return current[2]
+            self.misses += 1
+            signature = self.signature(key)
+            with metrics.LOAD_SECONDS.time(self.name):
+                result = self.load(key)
+            self.current = (key, signature, result)
+            self.next_check = time.time() + check_interval
+            return result
+        finally:
+            self.load_lock.release()
+
+    def _refresh(self, current):
+        """
+        Replaces current snapshot if its source has changed.
+        """
+        key = current[0]
+        try:
+            signature = self.signature(key)
+            if signature == current[1]:
+                return
+            with metrics.LOCK_WAIT_SECONDS.time(self.name):
+                self.load_lock.acquire()
+            try:
+                with metrics.LOAD_SECONDS.time(self.name):
+                    result = self.load(key)
+                # snapshot of another key may have been loaded meanwhile
+                if self.current is current:
+                    self.current = (key, signature, result)
+                    self.refreshes += 1
+            finally:
+                self.load_lock.release()
+        except Exception:  # pylint: disable-msg=W0703
+            metrics.LOAD_FAILURES.inc(self.name)
+            log.exception('Refreshing %s failed', self.name)
+        finally:
+            self.refresh_lock.release()
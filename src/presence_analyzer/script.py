@@ -26,10 +26,30 @@ del _buildout_path
 
 
 # bin/paster serve parts/etc/deploy.ini
-def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
+# settings override the config file, e.g. to turn background jobs off
+def make_app(global_conf={}, config=DEPLOY_CFG, debug=False, settings=None):
     from presence_analyzer import app
+    from presence_analyzer import profiling, utils
+    from presence_analyzer.partitions import is_partitioned
     app.config.from_pyfile(abspath(config))
+    app.config.update(settings or {})
     app.debug = debug
+    profiling.install(app)
+    # fork the parsing processes before any thread is started
+    if is_partitioned(app.config['DATA_CSV']):
+        if app.config.get('SHARED_DATA_DIR'):
+            utils.shared_presence().loader.start()
+        else:
+            utils.PRESENCE_LOADER.start()
+    if app.config.get('XML_SYNC_INTERVAL'):
+        synchronizer = utils.xml_synchronizer()
+        if synchronizer.thread is None:
+            synchronizer.start(app.config['XML_SYNC_INTERVAL'])
+    if app.config.get('WARM_UP'):
+        warm_up = utils.warm_up()
+        warm_up.start()
+        if app.config.get('WARM_UP_WAIT', True):
+            warm_up.wait()
     return app
 
 
@@ -78,6 +98,22 @@ def _serve(action, debug=False, dry_run=False):
     paste.script.command.run()
 
 
+def _snapshot(debug=False):
+    """Compile DATA_CSV into the binary snapshot DATA_SNAPSHOT."""
+    from presence_analyzer import app
+    from presence_analyzer.binstore import write_snapshot
+    from presence_analyzer.partitions import PartitionedCSVLoader
+    app.config.from_pyfile(abspath(DEBUG_CFG if debug else DEPLOY_CFG))
+    target = app.config['DATA_SNAPSHOT']
+    if not target:
+        print 'DATA_SNAPSHOT is not configured'
+        return
+    store = PartitionedCSVLoader().load(app.config['DATA_CSV'])
+    write_snapshot(store, target)
+    print 'Wrote %d rows of %d users to %s' % (
+        store.rows(), len(store), target)
+
+
 # bin/flask-ctl ...
 def run():
     action_shell = werkzeug.script.make_shell(make_shell, make_shell.__doc__)
@@ -100,6 +136,19 @@ def run():
         """Serve the debugging application."""
         _serve(action, debug=True, dry_run=dry_run)
 
+    # bin/flask-ctl snapshot
+    def action_snapshot(debug=False):
+        """Compile presence data into a binary snapshot.
+
+        Reads DATA_CSV and writes a memory-mappable snapshot to
+        DATA_SNAPSHOT, which get_data() serves instead of the CSV.
+        Run it again whenever the CSV changes.
+
+        Options:
+         - '--debug' use the debugging configuration
+        """
+        _snapshot(debug=debug)
+
     # bin/flask-ctl status
     def action_status(dry_run=False):
         """Status of the application."""
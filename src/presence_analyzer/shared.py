@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Presence data shared by worker processes through memory-mapped snapshots.
+"""
+
+import errno
+import fcntl
+import glob
+import logging
+import mmap
+import os
+import struct
+import threading
+
+from presence_analyzer.binstore import load_snapshot, write_snapshot
+from presence_analyzer.partitions import (
+    PartitionedCSVLoader, source_signature,
+)
+
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+GENERATION = struct.Struct('<Q')
+
+
+class SharedPresence(object):
+    """
+    Publishes or attaches presence data in a directory shared by processes.
+
+    The process which holds the exclusive flock() of ``publisher.lock`` is
+    the publisher: it parses the CSV (incrementally, see
+    PartitionedCSVLoader) and whenever it changes writes a binstore
+    snapshot ``presence-N.snapshot`` and bumps the generation counter N in
+    the memory-mapped ``generation`` file. All other processes are
+    readers: they read the counter straight from memory and map the
+    snapshot of a new generation read-only, so the dataset is held once in
+    the page cache however many processes serve it. When the publisher
+    exits, the next process to check takes over.
+
+    Given check_interval, the publisher also checks the CSV every
+    check_interval seconds in a background thread and publishes its
+    changes, so readers get fresh data even when the publisher process
+    serves no requests.
+
+    signature() and load() are meant to be used by a SnapshotCache keyed
+    by the CSV path.
+    """
+
+    def __init__(self, directory, check_interval=None):
+        self.directory = directory
+        self.check_interval = check_interval
+        try:
+            os.makedirs(directory)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+        self.lock_file = None
+        self.generation_map = None
+        self.loader = PartitionedCSVLoader()
+        # (source_signature(), snapshot path) last published by this process
+        self.published = None
+        self.publish_lock = threading.Lock()
+        self.watched = None
+        self.watcher = None
+        self.stopped = threading.Event()
+
+    @property
+    def publisher(self):
+        """
+        Tells if this process is the publisher.
+        """
+        return self.lock_file is not None
+
+    def path(self, name):
+        """
+        Returns path of a file in the shared directory.
+        """
+        return os.path.join(self.directory, name)
+
+    def snapshot_path(self, generation):
+        """
+        Returns path of the snapshot of given generation.
+        """
+        return self.path('presence-%d.snapshot' % generation)
+
+    def signature(self, csv_path):
+        """
+        Returns signature of the data this process should serve.
+        """
+        self._try_publish()
+        if self.publisher:
+            return ('publisher', source_signature(csv_path))
+        return ('reader', self.read_generation())
+
+    def load(self, csv_path):
+        """
+        Returns the shared store, publishing a new generation if needed.
+        """
+        self._try_publish()
+        if self.publisher:
+            self._watch(csv_path)
+            return load_snapshot(self.publish_source(csv_path))
+
+        generation = self.read_generation()
+        while generation:
+            try:
+                return load_snapshot(self.snapshot_path(generation))
+            except (IOError, OSError):
+                # removed by the publisher in the meantime
+                newer = self.read_generation()
+                if newer == generation:
+                    raise
+                generation = newer
+
+        # nothing was published yet, don't wait for it
+        return self.loader.load(csv_path)
+
+    def read_generation(self):
+        """
+        Returns the last published generation, 0 if there's none.
+        """
+        if self.generation_map is None:
+            try:
+                with open(self.path('generation'), 'rb') as generation:
+                    self.generation_map = mmap.mmap(
+                        generation.fileno(), GENERATION.size,
+                        access=mmap.ACCESS_READ,
+                    )
+            except (IOError, OSError, ValueError):
+                return 0
+        return GENERATION.unpack_from(self.generation_map)[0]
+
+    def publish_source(self, csv_path):
+        """
+        Publishes the CSV unless its current version already is published,
+        returns path of its snapshot.
+        """
+        with self.publish_lock:
+            signature = source_signature(csv_path)
+            if self.published is None or self.published[0] != signature:
+                store = self.loader.load(csv_path)
+                self.published = (signature, self.publish(store))
+            return self.published[1]
+
+    def publish(self, store):
+        """
+        Writes store as the next generation and returns its path.
+        """
+        generation = self.read_generation() + 1
+        path = self.snapshot_path(generation)
+        write_snapshot(store, path)
+
+        counter = self.path('generation')
+        if not os.path.exists(counter):
+            with open(counter, 'wb') as counter_file:
+                counter_file.write(GENERATION.pack(0))
+        with open(counter, 'r+b') as counter_file:
+            writable = mmap.mmap(counter_file.fileno(), GENERATION.size)
+            GENERATION.pack_into(writable, 0, generation)
+            writable.close()
+
+        # readers still mapping old snapshots keep them until they swap
+        for old in glob.glob(self.path('presence-*.snapshot')):
+            if old not in (path, self.snapshot_path(generation - 1)):
+                os.remove(old)
+        return path
+
+    def close(self):
+        """
+        Gives up the publisher role, if held.
+        """
+        self.stopped.set()
+        if self.watcher is not None:
+            self.watcher.join()
+            self.watcher = None
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def _try_publish(self):
+        """
+        Becomes the publisher if no other process is.
+        """
+        if self.lock_file is not None:
+            return
+        lock_file = open(self.path('publisher.lock'), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as error:
+            lock_file.close()
+            if error.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return
+        log.info('Process %d publishes presence data', os.getpid())
+        self.lock_file = lock_file
+        self.loader.reset()
+        self.published = None
+
+    def _watch(self, csv_path):
+        """
+        Starts publishing changes of the CSV in the background, if enabled.
+        """
+        self.watched = csv_path
+        if self.check_interval is None or self.watcher is not None:
+            return
+        self.stopped.clear()
+        self.watcher = threading.Thread(
+            target=self._run, name='shared-publisher',
+        )
+        self.watcher.daemon = True
+        self.watcher.start()
+
+    def _run(self):
+        """
+        Publishing loop, errors are logged and retried next time.
+        """
+        while not self.stopped.wait(self.check_interval):
+            try:
+                self.publish_source(self.watched)
+            except Exception:  # pylint: disable-msg=W0703
+                log.exception('Publishing %s failed', self.watched)
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Mergeable quantile sketches of presence times.
+"""
+
+import sys
+from array import array
+from binascii import hexlify, unhexlify
+from bisect import bisect_right
+from itertools import imap, izip
+from operator import add
+
+from presence_analyzer.aggregates import FIELDS, group_by_weekday
+
+# Width of a sketch bucket in seconds, quantiles are within half of it.
+RESOLUTION = 60
+# Typecode of bucket counters.
+COUNTER_TYPECODE = 'I'
+# Width of a bucket counter in bits.
+COUNTER_BITS = array(COUNTER_TYPECODE).itemsize * 8
+
+
+class QuantileSketch(object):
+    """
+    Histogram of integer values in buckets of RESOLUTION seconds.
+
+    Only the buckets between the lowest and the highest value are kept, as
+    a single array of cumulative counts, so a user's weekday sketch takes a
+    few hundred bytes whatever the length of the history and quantiles are
+    found by binary search. Sketches are merged by adding the counters,
+    which gives exactly the sketch of all values together.
+    """
+
+    __slots__ = ('low', 'cumulative')
+
+    def __init__(self, values=()):
+        buckets = [value // RESOLUTION for value in values]
+        self.low = min(buckets) if buckets else 0
+        counts = [0] * (max(buckets) - self.low + 1 if buckets else 0)
+        for bucket in buckets:
+            counts[bucket - self.low] += 1
+        self.cumulative = array(COUNTER_TYPECODE)
+        total = 0
+        for count in counts:
+            total += count
+            self.cumulative.append(total)
+
+    def __len__(self):
+        return self.cumulative[-1] if self.cumulative else 0
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, QuantileSketch) and
+            (self.low, self.cumulative) == (other.low, other.cumulative)
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+    @property
+    def high(self):
+        """
+        Returns the highest bucket.
+        """
+        return self.low + len(self.cumulative) - 1
+
+    def _aligned(self, low, high):
+        """
+        Returns cumulative counts over buckets from low to high.
+        """
+        cumulative = array(COUNTER_TYPECODE, [0]) * (self.low - low)
+        cumulative.extend(self.cumulative)
+        cumulative.extend(
+            array(COUNTER_TYPECODE, [len(self)]) * (high - self.high)
+        )
+        return cumulative
+
+    def merged(self, other):
+        """
+        Returns a new sketch of values of both sketches.
+        """
+        if not other.cumulative:
+            return self
+        if not self.cumulative:
+            return other
+        result = QuantileSketch()
+        result.low = min(self.low, other.low)
+        high = max(self.high, other.high)
+        result.cumulative = array(COUNTER_TYPECODE, imap(
+            add,
+            self._aligned(result.low, high),
+            other._aligned(result.low, high),
+        ))
+        return result
+
+    def quantile(self, fraction):
+        """
+        Returns approximate value below which given fraction of values falls.
+
+        The middle of the bucket holding the value of rank fraction * count
+        is returned, zero if the sketch is empty.
+        """
+        count = len(self)
+        if not count:
+            return 0
+        rank = min(int(count * fraction), count - 1)
+        bucket = self.low + bisect_right(self.cumulative, rank)
+        return bucket * RESOLUTION + RESOLUTION // 2
+
+
+def weekday_sketches(days, starts, ends):
+    """
+    Returns sketches of (days, starts, ends) columns of a single user.
+
+    The result is a tuple of seven tuples (one per weekday, Monday is 0)
+    of QuantileSketch of FIELDS.
+    """
+    return tuple(
+        tuple(QuantileSketch(values) for values in group)
+        for group in group_by_weekday(days, starts, ends)
+    )
+
+
+def merge_weekday_sketches(first, second):
+    """
+    Merges two weekday_sketches() results.
+    """
+    return tuple(
+        tuple(a.merged(b) for a, b in izip(weekday_a, weekday_b))
+        for weekday_a, weekday_b in izip(first, second)
+    )
+
+
+def _packed(counters):
+    """
+    Returns counters as a single long, counter i at bit COUNTER_BITS * i.
+    """
+    if sys.byteorder == 'big':
+        counters = array(COUNTER_TYPECODE, counters)
+        counters.byteswap()
+    return long(hexlify(counters.tostring()[::-1]) or '0', 16)
+
+
+def _unpacked(packed, size):
+    """
+    Returns array of size counters packed by _packed().
+    """
+    counters = array(COUNTER_TYPECODE)
+    counters.fromstring(
+        unhexlify('%0*x' % (size * COUNTER_BITS // 4, packed))[::-1]
+    )
+    if sys.byteorder == 'big':
+        counters.byteswap()
+    return counters
+
+
+def merge_sketches(sketches):
+    """
+    Returns a sketch of values of all given sketches.
+
+    Folding merged() costs the whole merged range per sketch in Python
+    integer additions. Here the cumulative counters of every sketch are
+    packed into a long, shifted to their place and added in one C-level
+    bignum addition; fields don't carry into each other, as no counter
+    exceeds the total number of values. Totals of sketches ending below a
+    bucket are then carried to it in a single pass.
+    """
+    sketches = [sketch for sketch in sketches if sketch.cumulative]
+    result = QuantileSketch()
+    if not sketches:
+        return result
+    result.low = min(sketch.low for sketch in sketches)
+    size = max(sketch.high for sketch in sketches) - result.low + 1
+    packed = 0
+    # totals of sketches ending below a bucket, carried to it and above
+    carried = [0] * (size + 1)
+    for sketch in sketches:
+        lo = sketch.low - result.low
+        packed += _packed(sketch.cumulative) << (COUNTER_BITS * lo)
+        carried[lo + len(sketch.cumulative)] += len(sketch)
+    cumulative = _unpacked(packed, size)
+    total = 0
+    for bucket in xrange(size):
+        total += carried[bucket]
+        cumulative[bucket] += total
+    result.cumulative = cumulative
+    return result
+
+
+def describe_sketches(sketches, percentiles):
+    """
+    Returns {field: {'p<N>': value}} of each weekday of weekday_sketches().
+    """
+    return [
+        {
+            field: {
+                'p%d' % value: sketch.quantile(value / 100.0)
+                for value in percentiles
+            }
+            for field, sketch in izip(FIELDS, weekday)
+        }
+        for weekday in sketches
+    ]
+
+
+def precompute(store, users=None, previous=None, appended=None):
+    """
+    Materializes weekday_sketches() of every user of the store.
+
+    Only users in given collection are computed (all by default), sketches
+    of the others are taken from previous precompute() result. Users which
+    appended maps to the number of their previous rows only got rows after
+    their last day, so sketches of the new rows are merged into the
+    previous ones instead.
+    """
+    appended = appended or {}
+    result = {}
+    for user_id, (lo, hi) in store.offsets.iteritems():
+        if previous is None or user_id not in previous:
+            result[user_id] = weekday_sketches(*store.columns(user_id))
+        elif users is not None and user_id not in users:
+            result[user_id] = previous[user_id]
+        elif user_id in appended:
+            lo += appended[user_id]
+            result[user_id] = merge_weekday_sketches(
+                previous[user_id],
+                weekday_sketches(
+                    store.days[lo:hi], store.starts[lo:hi], store.ends[lo:hi],
+                ),
+            )
+        else:
+            result[user_id] = weekday_sketches(*store.columns(user_id))
+    return result
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar, array-backed storage of presence data.
+"""
+
+import datetime
+from array import array
+from bisect import bisect_left, bisect_right
+
+from presence_analyzer.aggregates import expand_totals, weekday_totals
+from presence_analyzer.metrics import timed
+from presence_analyzer.sketch import describe_sketches, weekday_sketches
+
+# Typecode of the 32-bit signed integer columns (day ordinals and seconds).
+COLUMN_TYPECODE = 'i'
+
+
+def seconds_to_time(seconds):
+    """
+    Converts amount of seconds since midnight to datetime.time object.
+    """
+    return datetime.time(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def weekday_of(day):
+    """
+    Returns weekday (Monday is 0) of a date given as proleptic ordinal.
+    """
+    # date.fromordinal(1) is Monday, 0001-01-01.
+    return (day + 6) % 7
+
+
+class PresenceStore(object):
+    """
+    Read-only presence data kept in three flat integer columns.
+
+    Rows are sorted by user and day. Rows of a single user occupy
+    ``days[lo:hi]``, ``starts[lo:hi]`` and ``ends[lo:hi]`` where
+    ``(lo, hi) = offsets[user_id]``. Days are proleptic Gregorian ordinals,
+    starts and ends are seconds since midnight.
+
+    ``aggregates`` optionally holds weekday_totals() of every user,
+    materialized once when the store is loaded. ``sketches`` holds
+    weekday_sketches() of users, either materialized on load as well or
+    filled in when they're first needed.
+    """
+
+    def __init__(self, days, starts, ends, offsets, version=None,
+                 aggregates=None, sketches=None):
+        self.days = days
+        self.starts = starts
+        self.ends = ends
+        self.offsets = offsets
+        self.version = version
+        self.aggregates = aggregates
+        self.sketches = sketches if sketches is not None else {}
+
+    def __contains__(self, user_id):
+        return user_id in self.offsets
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __eq__(self, other):
+        if not isinstance(other, PresenceStore):
+            return NotImplemented
+        return (
+            self.offsets == other.offsets and
+            self.days == other.days and
+            self.starts == other.starts and
+            self.ends == other.ends
+        )
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __getitem__(self, user_id):
+        """
+        Returns presence of given user in the legacy dict layout:
+        {datetime.date: {'start': datetime.time, 'end': datetime.time}}.
+        """
+        days, starts, ends = self.columns(user_id)
+        return {
+            datetime.date.fromordinal(day): {
+                'start': seconds_to_time(start),
+                'end': seconds_to_time(end),
+            }
+            for day, start, end in zip(days, starts, ends)
+        }
+
+    def keys(self):
+        """
+        Returns sorted list of user ids.
+        """
+        return sorted(self.offsets)
+
+    def rows(self):
+        """
+        Returns total number of stored rows.
+        """
+        return len(self.days)
+
+    def columns(self, user_id, first=None, last=None):
+        """
+        Returns (days, starts, ends) columns of given user.
+
+        Rows can be limited to days from first to last (inclusive ordinals),
+        found by binary search in O(log n).
+        """
+        lo, hi = self.offsets[user_id]
+        if first is not None:
+            lo = bisect_left(self.days, first, lo, hi)
+        if last is not None:
+            hi = bisect_right(self.days, last, lo, hi)
+        return self.days[lo:hi], self.starts[lo:hi], self.ends[lo:hi]
+
+    def weekday_totals(self, user_id, first=None, last=None):
+        """
+        Returns weekday_totals() of given user.
+
+        Totals of the whole history are precomputed, the ones limited to
+        days from first to last are computed from the matching rows only.
+        """
+        totals = None
+        if self.aggregates is not None and first is None and last is None:
+            totals = self.aggregates.get(user_id)
+        if totals is None:
+            totals = weekday_totals(*self.columns(user_id, first, last))
+        return totals
+
+    def weekday_sketches(self, user_id, first=None, last=None):
+        """
+        Returns weekday_sketches() of given user.
+
+        Sketches of the whole history are kept, the ones limited to days
+        from first to last are computed from the matching rows only.
+        """
+        if first is not None or last is not None:
+            return weekday_sketches(*self.columns(user_id, first, last))
+        sketches = self.sketches.get(user_id)
+        if sketches is None:
+            sketches = self.sketches[user_id] = weekday_sketches(
+                *self.columns(user_id)
+            )
+        return sketches
+
+    @timed('aggregate')
+    def weekday_stats(self, user_id, first=None, last=None,
+                      percentiles=()):
+        """
+        Returns weekday statistics of given user, see expand_totals().
+
+        Approximate percentiles of every field, e.g. 'p50' for 50, are
+        added from the user's quantile sketches.
+        """
+        stats = expand_totals(self.weekday_totals(user_id, first, last))
+        if percentiles:
+            sketches = describe_sketches(
+                self.weekday_sketches(user_id, first, last), percentiles,
+            )
+            for weekday, quantiles in zip(stats, sketches):
+                for field, values in quantiles.iteritems():
+                    weekday[field].update(values)
+        return stats
+
+    def nbytes(self):
+        """
+        Returns approximate amount of memory used by the columns.
+        """
+        return sum(
+            column.itemsize * len(column)
+            for column in (self.days, self.starts, self.ends)
+        )
+
+
+class PresenceStoreBuilder(object):
+    """
+    Collects presence rows in any order and builds a PresenceStore.
+
+    When a user has more than one row for the same day, the last one added
+    wins, the same way it did with the nested dict layout.
+    """
+
+    def __init__(self):
+        self._users = {}
+        self._unsorted = set()
+        self._previous_rows = {}
+        # users with rows added by add()
+        self.touched = set()
+
+    @classmethod
+    def from_store(cls, store):
+        """
+        Creates builder holding copies of all rows of given store.
+        """
+        builder = cls()
+        for user_id in store.offsets:
+            builder._users[user_id] = store.columns(user_id)
+            builder._previous_rows[user_id] = len(builder._users[user_id][0])
+        return builder
+
+    def appended(self):
+        """
+        Returns {user_id: number of previous rows} of users of the store
+        passed to from_store() which only got rows after their last day.
+        """
+        return dict(
+            (user_id, rows)
+            for user_id, rows in self._previous_rows.iteritems()
+            if user_id in self.touched and user_id not in self._unsorted
+        )
+
+    def _columns(self, user_id):
+        """
+        Returns columns of given user, marking the user as touched.
+        """
+        self.touched.add(user_id)
+        try:
+            return self._users[user_id]
+        except KeyError:
+            columns = self._users[user_id] = (
+                array(COLUMN_TYPECODE),
+                array(COLUMN_TYPECODE),
+                array(COLUMN_TYPECODE),
+            )
+            return columns
+
+    def add(self, user_id, day, start, end):
+        """
+        Adds single row. Day is an ordinal, start and end are seconds.
+        """
+        days, starts, ends = self._columns(user_id)
+        if days and day <= days[-1]:
+            self._unsorted.add(user_id)
+        days.append(day)
+        starts.append(start)
+        ends.append(end)
+
+    def extend(self, user_id, days, starts, ends):
+        """
+        Adds many rows of a single user at once, as columns sorted by day.
+        """
+        if not days:
+            return
+        user_days, user_starts, user_ends = self._columns(user_id)
+        if user_days and days[0] <= user_days[-1]:
+            self._unsorted.add(user_id)
+        user_days.extend(days)
+        user_starts.extend(starts)
+        user_ends.extend(ends)
+
+    def build(self, version=None):
+        """
+        Sorts collected rows and packs them into a PresenceStore.
+        """
+        days = array(COLUMN_TYPECODE)
+        starts = array(COLUMN_TYPECODE)
+        ends = array(COLUMN_TYPECODE)
+        offsets = {}
+        for user_id in sorted(self._users):
+            user_days, user_starts, user_ends = self._users[user_id]
+            if user_id in self._unsorted:
+                user_days, user_starts, user_ends = _sorted_columns(
+                    user_days, user_starts, user_ends
+                )
+            lo = len(days)
+            days.extend(user_days)
+            starts.extend(user_starts)
+            ends.extend(user_ends)
+            offsets[user_id] = (lo, len(days))
+        return PresenceStore(days, starts, ends, offsets, version=version)
+
+
+def _sorted_columns(days, starts, ends):
+    """
+    Sorts columns of a single user by day, keeping the last row of each day.
+    """
+    # sorted() is stable, so the last row of a day ends up last.
+    order = sorted(xrange(len(days)), key=days.__getitem__)
+    result = tuple(array(COLUMN_TYPECODE) for _ in range(3))
+    for position, i in enumerate(order):
+        is_last = (
+            position + 1 == len(order) or
+            days[order[position + 1]] != days[i]
+        )
+        if is_last:
+            result[0].append(days[i])
+            result[1].append(starts[i])
+            result[2].append(ends[i])
+    return result
@@ -2,13 +2,32 @@
 """
 Presence analyzer unit tests.
 """
+import BaseHTTPServer
+import calendar
+import os
 import os.path
 import json
+import random
+import shutil
+import StringIO
+import sys
+import tempfile
+import threading
+import time
 import datetime
 import unittest
+import urllib2
+import wsgiref.simple_server
 
 from time import sleep
-from presence_analyzer import main, views, utils
+from presence_analyzer import main, views, utils, store, aggregates
+from presence_analyzer import csvparser, loader, lrucache, refresher
+from presence_analyzer import benchmarks, loadtest, metrics, partitions
+from presence_analyzer import profiling, warmup
+from presence_analyzer import collation, xmlsync, binstore, shared, sketch
+import flask
+import werkzeug.test
+import werkzeug.wrappers
 from flask import render_template
 
 
@@ -148,6 +167,193 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
             ],
         )
 
+    def test_date_range(self):
+        """
+        Testing if presence views can be limited to a date range.
+        """
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10?from=2013-09-11&to=2013-09-11'
+        )
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data[2], [u'Tue', 0])
+        self.assertEqual(data[3], [u'Wed', 24465])
+        self.assertEqual(data[4], [u'Thu', 0])
+
+        resp = self.client.get('/api/v1/mean_time_weekday/10?from=2013-09-11')
+        data = json.loads(resp.data)
+        self.assertEqual(data[1], [u'Tue', 0])
+        self.assertEqual(data[3], [u'Thu', 23705.0])
+
+        resp = self.client.get('/api/v1/presence_start_end/10?to=2013-09-10')
+        data = json.loads(resp.data)
+        self.assertEqual(data[1], [u'Tue', 34745.0, 64792.0])
+        self.assertEqual(data[2], [u'Wed', 0, 0])
+
+        resp = self.client.get('/api/v1/presence_weekday/10?from=2013-13-01')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_batch_view(self):
+        """
+        Testing if metrics of many users are returned at once.
+        """
+        resp = self.client.get(
+            '/api/v1/batch?users=10,11,1&metrics=presence_weekday'
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(sorted(data), [u'1', u'10', u'11'])
+        self.assertEqual(
+            data[u'10'][u'presence_weekday'],
+            json.loads(self.client.get('/api/v1/presence_weekday/10').data),
+        )
+        self.assertEqual(data[u'1'], {u'presence_weekday': []})
+
+        data = json.loads(self.client.get('/api/v1/batch?users=all').data)
+        self.assertEqual(sorted(data), [u'10', u'11'])
+        self.assertEqual(
+            sorted(data[u'11']),
+            [u'mean_time_weekday', u'presence_start_end', u'presence_weekday'],
+        )
+        self.assertEqual(
+            data[u'11'][u'presence_start_end'],
+            json.loads(self.client.get('/api/v1/presence_start_end/11').data),
+        )
+
+        for query in ('', '?users=x', '?users=all&metrics=unknown'):
+            resp = self.client.get('/api/v1/batch' + query)
+            self.assertEqual(resp.status_code, 400)
+
+    def test_presence_summary_view(self):
+        """
+        Testing weekday statistics of all or selected users.
+        """
+        resp = self.client.get('/api/v1/presence_summary')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual([weekday for weekday, _ in data],
+                         list(calendar.day_abbr))
+        self.assertEqual(data[1][1]['users'], 2)
+        self.assertEqual(data[1][1]['count'], 2)
+        self.assertEqual(data[1][1]['duration']['sum'], 30047 + 16564)
+        self.assertEqual(data[4][1]['users'], 1)
+
+        resp = self.client.get(
+            '/api/v1/presence_summary?users=10&from=2013-09-11'
+        )
+        data = json.loads(resp.data)
+        self.assertEqual(data[1][1]['count'], 0)
+        self.assertEqual(data[2][1]['duration']['p50'], 24465)
+        self.assertEqual(data[4][1]['users'], 0)
+
+    def test_export_view(self):
+        """
+        Testing streamed export of raw rows and weekday totals.
+        """
+        resp = self.client.get('/api/v1/export')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/csv')
+        self.assertFalse(resp.is_sequence)
+        lines = resp.data.splitlines()
+        self.assertEqual(lines[0], 'user_id,date,start,end')
+        self.assertEqual(lines[1], '10,2013-09-10,09:39:05,17:59:52')
+        self.assertEqual(len(lines), 10)
+
+        resp = self.client.get(
+            '/api/v1/export?kind=weekday&format=ndjson&users=11,1'
+        )
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        rows = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual(len(rows), 7)
+        self.assertEqual(rows[1]['weekday'], u'Tue')
+        self.assertEqual(rows[1]['duration_sum'], 16564)
+        self.assertIsNone(rows[5]['start_min'])
+
+        resp = self.client.get('/api/v1/export?users=10&from=2013-09-12')
+        self.assertEqual(resp.data.splitlines()[1:],
+                         ['10,2013-09-12,10:48:46,17:23:51'])
+
+        resp = self.client.get('/api/v1/export?users=1')
+        self.assertEqual(resp.data, 'user_id,date,start,end\n')
+
+        resp = self.client.get('/api/v1/export?format=xml')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_statistic(self):
+        """
+        Testing if views return medians and percentiles on demand.
+        """
+        resp = self.client.get('/api/v1/presence_start_end/11?stat=median')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data[0], [u'Mon', 33150, 57270])
+        resp = self.client.get('/api/v1/mean_time_weekday/11?stat=p90')
+        data = json.loads(resp.data)
+        self.assertEqual(data[1], [u'Tue', 16590])
+        self.assertEqual(data[5], [u'Sat', 0])
+        resp = self.client.get(
+            '/api/v1/batch?users=11&metrics=mean_time_weekday&stat=p10'
+        )
+        data = json.loads(resp.data)
+        self.assertEqual(data[u'11'][u'mean_time_weekday'][1], [u'Tue', 16590])
+        resp = self.client.get('/api/v1/mean_time_weekday/11?stat=mode')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_etag(self):
+        """
+        Testing if responses carry ETag and answer If-None-Match.
+        """
+        resp = self.client.get('/api/v1/mean_time_weekday/10')
+        etag = resp.headers['ETag']
+        self.assertTrue(etag.startswith('"'))
+        resp = self.client.get(
+            '/api/v1/mean_time_weekday/10',
+            headers={'If-None-Match': etag},
+        )
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, '')
+        self.assertEqual(resp.headers['ETag'], etag)
+
+        resp = self.client.get(
+            '/api/v1/mean_time_weekday/11',
+            headers={'If-None-Match': etag},
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_cached_json(self):
+        """
+        Testing if encoded bodies are cached per arguments and version.
+        """
+        calls = []
+        version = [1]
+
+        @utils.cached_json(version=lambda: version[0])
+        def echo(value):
+            """
+            Returns the value and records the call.
+            """
+            calls.append(value)
+            return [value]
+
+        with main.app.test_request_context():
+            first = echo(1)
+            self.assertEqual(json.loads(first.data), [1])
+            self.assertEqual(echo(1).headers['ETag'], first.headers['ETag'])
+            echo(2)
+            self.assertEqual(len(echo.cache), 2)
+            version[0] = 2
+            self.assertNotEqual(
+                echo(1).headers['ETag'],
+                first.headers['ETag'],
+            )
+            # bodies of version 1 are dropped
+            self.assertEqual(len(echo.cache), 1)
+        self.assertEqual(calls, [1, 2, 1])
+        self.assertEqual(echo.cache.max_bytes, utils.RESPONSE_CACHE_BYTES)
+
     def test_template_view(self):
         """
         Testing if templates are rendered properly
@@ -188,7 +394,7 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         Test parsing of CSV file.
         """
         data = utils.get_data()
-        self.assertIsInstance(data, dict)
+        self.assertIsInstance(data, store.PresenceStore)
         self.assertItemsEqual(data.keys(), [10, 11])
         sample_date = datetime.date(2013, 9, 10)
         self.assertIn(sample_date, data[10])
@@ -294,6 +500,55 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             }
         )
 
+    def test_get_users(self):
+        """
+        Testing if users XML is parsed and sorted once per version.
+        """
+        users = utils.get_users()
+        self.assertIs(utils.get_users(), users)
+        self.assertIs(utils.parse_users_xml(), users['users'])
+        self.assertEqual(
+            [user_id for user_id, _ in users['listing']],
+            [141, 176, 170, 26, 165],
+        )
+        self.assertEqual(utils.users_version(), users['version'])
+
+    def test_iter_users_xml(self):
+        """
+        Testing streaming users XML parsing.
+        """
+        xmlfile = StringIO.StringIO(
+            '<intranet><users>'
+            '<user id="2"><avatar>/a/2</avatar><name>Bob</name></user>'
+            '</users><server><host>example.com</host>'
+            '<protocol>http</protocol></server><users>'
+            '<user id="1"><name>Ann</name><avatar>/a/1</avatar></user>'
+            '</users></intranet>'
+        )
+        self.assertEqual(
+            list(utils.iter_users_xml(xmlfile)),
+            [
+                (2, 'Bob', 'http://example.com/a/2'),
+                (1, 'Ann', 'http://example.com/a/1'),
+            ],
+        )
+
+    def test_polish_sort_key(self):
+        """
+        Testing built-in Polish collation.
+        """
+        names = [u'Łukasz', u'zenon', u'Lucjan', u'Ćma', u'Żaneta', u'cezary',
+                 u'Adam P.', u'adam', u'Źdźbło']
+        self.assertEqual(
+            sorted(names, key=collation.polish_sort_key),
+            [u'adam', u'Adam P.', u'cezary', u'Ćma', u'Lucjan', u'Łukasz',
+             u'zenon', u'Źdźbło', u'Żaneta'],
+        )
+        self.assertEqual(
+            collation.polish_sort_key('Adam'),
+            collation.polish_sort_key(u'Adam'),
+        )
+
     def test_cache_function(self):
         """
         Testing caching function
@@ -302,15 +557,1551 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         with open(TEST_CACHE_DATA_CSV, 'w') as test_data_file:
             test_data_file.write('13,2011-07-09,09:21:46,16:59:43')
         new_data = utils.get_data()
-        self.assertDictEqual(data, new_data)
+        self.assertEqual(data, new_data)
         main.app.config.update({'DATA_CSV': TEST_CACHE_DATA_CSV})
-        utils.CACHE = {}
-        utils.TIMESTAMPS = {}
+        utils.PRESENCE_DATA.clear()
         new_data = utils.get_data()
         self.assertNotEqual(data, new_data)
         main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
-        utils.CACHE = {}
-        utils.TIMESTAMPS = {}
+        utils.PRESENCE_DATA.clear()
+
+
+class PresenceAnalyzerMetricsTestCase(unittest.TestCase):
+    """
+    Metrics tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+        self.client = main.app.test_client()
+
+    def test_histogram(self):
+        """
+        Testing cumulative buckets, sum and count of a histogram.
+        """
+        registry = metrics.Registry()
+        histogram = registry.register(metrics.Histogram(
+            'test_seconds', 'Test.', labels=('name',), buckets=(0.1, 1),
+        ))
+        histogram.observe(0.05, 'a"b')
+        histogram.observe(0.5, 'a"b')
+        histogram.observe(5, 'a"b')
+        with histogram.time('c'):
+            pass
+        self.assertEqual(histogram.count('a"b'), 3)
+        self.assertEqual(histogram.count('d'), 0)
+        lines = registry.render().splitlines()
+        self.assertEqual(lines[:7], [
+            '# HELP test_seconds Test.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{name="a\\"b",le="0.1"} 1',
+            'test_seconds_bucket{name="a\\"b",le="1"} 2',
+            'test_seconds_bucket{name="a\\"b",le="+Inf"} 3',
+            'test_seconds_sum{name="a\\"b"} 5.55',
+            'test_seconds_count{name="a\\"b"} 3',
+        ])
+        self.assertEqual(lines[-1], 'test_seconds_count{name="c"} 1')
+
+    def test_counter(self):
+        """
+        Testing counters and collected metrics.
+        """
+        registry = metrics.Registry()
+        counter = registry.register(metrics.Counter('test_total', 'Test.'))
+        counter.inc()
+        counter.inc()
+        registry.register(metrics.Collected(
+            'test_ratio', 'Test.', ('cache',), lambda: {('x',): 0.5},
+        ))
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP test_total Test.',
+            '# TYPE test_total counter',
+            'test_total 2',
+            '# HELP test_ratio Test.',
+            '# TYPE test_ratio gauge',
+            'test_ratio{cache="x"} 0.5',
+        ])
+
+    def test_stages(self):
+        """
+        Testing if loads, lock waits and stages are timed.
+        """
+        snapshot = refresher.SnapshotCache(
+            'metrics_test', lambda key: key, lambda key: key,
+        )
+        snapshot.get('a', 60)
+        self.assertEqual(metrics.LOAD_SECONDS.count('metrics_test'), 1)
+        self.assertEqual(metrics.LOCK_WAIT_SECONDS.count('metrics_test'), 1)
+
+        encoded = metrics.STAGE_SECONDS.count('encode')
+        aggregated = metrics.STAGE_SECONDS.count('aggregate')
+        self.client.get('/api/v1/presence_weekday/10?from=2000-01-01')
+        self.assertEqual(metrics.STAGE_SECONDS.count('encode'), encoded + 1)
+        self.assertEqual(
+            metrics.STAGE_SECONDS.count('aggregate'), aggregated + 1,
+        )
+
+    def test_metrics_view(self):
+        """
+        Testing metrics endpoint.
+        """
+        self.client.get('/api/v1/mean_time_weekday/10')
+        self.client.get('/api/v1/mean_time_weekday/10')
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/plain')
+        self.assertIn(
+            'presence_request_duration_seconds_count'
+            '{endpoint="mean_time_weekday_view"}',
+            resp.data,
+        )
+        self.assertIn('presence_cache_hits_total{cache="presence_data"}',
+                      resp.data)
+        self.assertIn(
+            'presence_cache_evictions_total'
+            '{cache="presence_analyzer.views.mean_time_weekday_view"}',
+            resp.data,
+        )
+        self.assertIn(
+            'presence_cache_hit_ratio'
+            '{cache="presence_analyzer.views.mean_time_weekday_view"}',
+            resp.data,
+        )
+
+
+def slow_wsgi_app(environ, start_response):  # pylint: disable-msg=W0613
+    """
+    WSGI application taking a while to respond.
+    """
+    sleep(0.05)
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return ['done']
+
+
+class PresenceAnalyzerProfilingTestCase(unittest.TestCase):
+    """
+    Request profiling tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.directory)
+
+    def request(self, middleware, path, headers=None):
+        """
+        Sends GET request through middleware.
+        """
+        client = werkzeug.test.Client(middleware, werkzeug.wrappers.Response)
+        return client.get(path, headers=headers or {})
+
+    def test_header(self):
+        """
+        Testing if header-flagged requests are profiled per endpoint.
+        """
+        middleware = profiling.ProfilingMiddleware(
+            main.app, slow_wsgi_app, self.directory, header='X-Profile',
+        )
+        resp = self.request(middleware, '/api/v1/users')
+        self.assertEqual(resp.data, 'done')
+        self.assertEqual(os.listdir(self.directory), [])
+
+        self.request(middleware, '/api/v1/users', {'X-Profile': '1'})
+        with open(middleware.path('users_view')) as folded:
+            lines = folded.read().splitlines()
+        self.assertTrue(lines)
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertGreater(int(count), 0)
+        self.assertIn('slow_wsgi_app (tests.py:', stack)
+        self.assertTrue(
+            stack.split(';')[-1].startswith('slow_wsgi_app')
+        )
+
+    def test_sample_rate(self):
+        """
+        Testing if sampled requests are profiled.
+        """
+        middleware = profiling.ProfilingMiddleware(
+            main.app, slow_wsgi_app, self.directory, sample_rate=1,
+            header=None,
+        )
+        self.request(middleware, '/no/such/page', {'X-Profile': '1'})
+        self.assertEqual(os.listdir(self.directory),
+                         ['profile-unknown.folded'])
+
+    def test_install(self):
+        """
+        Testing if middleware is installed only when configured.
+        """
+        app = flask.Flask('profiling_test')
+        wsgi_app = app.wsgi_app
+        profiling.install(app)
+        self.assertEqual(app.wsgi_app, wsgi_app)
+        app.config['PROFILE_DIR'] = self.directory
+        profiling.install(app)
+        profiling.install(app)
+        self.assertIsInstance(app.wsgi_app, profiling.ProfilingMiddleware)
+        self.assertEqual(app.wsgi_app.wsgi_app, wsgi_app)
+        # header triggered profiling must be enabled explicitly
+        self.assertIsNone(app.wsgi_app.environ_key)
+        self.assertIsNone(main.app.config['PROFILE_HEADER'])
+
+
+class PresenceAnalyzerLRUCacheTestCase(unittest.TestCase):
+    """
+    LRU cache tests.
+    """
+
+    def test_max_entries(self):
+        """
+        Testing if least recently used entries are evicted.
+        """
+        cache = lrucache.LRUCache('test', max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_max_bytes(self):
+        """
+        Testing if entries are evicted above the memory bound.
+        """
+        size = lrucache.approximate_size([1, 2, 3])
+        cache = lrucache.LRUCache('test', max_bytes=size * 2)
+        for key in range(3):
+            cache.set(key, [1, 2, 3])
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.nbytes, size * 2)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        cache.clear()
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+
+class PresenceAnalyzerSnapshotCacheTestCase(unittest.TestCase):
+    """
+    Background refreshed snapshot cache tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.source = {'value': 1, 'signature': 1}
+        self.calls = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.cache = refresher.SnapshotCache(
+            'test', self.load, lambda key: self.source['signature'],
+        )
+
+    def load(self, key):
+        """
+        Returns current value of the source once the gate is open.
+        """
+        self.calls.append(key)
+        self.gate.wait()
+        return self.source['value']
+
+    def test_stale_while_refreshing(self):
+        """
+        Testing if readers get previous snapshot during a single refresh.
+        """
+        self.assertEqual(self.cache.get('key', 0), 1)
+        self.source.update(value=2, signature=2)
+        self.gate.clear()
+        self.assertEqual(self.cache.get('key', 0), 1)
+        self.assertEqual(self.cache.get('key', 0), 1)
+        self.gate.set()
+        self.cache.wait()
+        self.assertEqual(self.cache.get('key', 60), 2)
+        self.assertEqual(self.calls, ['key', 'key'])
+        self.assertEqual(self.cache.stats()['refreshes'], 1)
+
+    def test_unchanged(self):
+        """
+        Testing if unchanged source isn't loaded again.
+        """
+        self.cache.get('key', 0)
+        self.cache.get('key', 0)
+        self.cache.wait()
+        self.assertEqual(self.cache.get('key', 0), 1)
+        self.assertEqual(self.calls, ['key'])
+
+    def test_key_changed(self):
+        """
+        Testing if snapshot of another key is loaded at once.
+        """
+        self.cache.get('key', 60)
+        self.source['value'] = 2
+        self.assertEqual(self.cache.get('other', 60), 2)
+        self.assertEqual(self.calls, ['key', 'other'])
+
+
+class UsersXMLHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves users XML with ETag, honouring If-None-Match.
+    """
+
+    def do_GET(self):  # pylint: disable=C0103
+        """
+        Responds with the current XML or 304 Not Modified.
+        """
+        self.server.requests.append(dict(self.headers))
+        if self.server.fail:
+            self.send_error(500)
+            return
+        etag = '"%d"' % hash(self.server.xml)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(self.server.xml)))
+        self.end_headers()
+        self.wfile.write(self.server.xml)
+
+    def log_message(self, *args):
+        """
+        Keeps test output quiet.
+        """
+        pass
+
+
+class PresenceAnalyzerXMLSyncTestCase(unittest.TestCase):
+    """
+    Users XML synchronization tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, start local HTTP server with users XML.
+        """
+        self.server = BaseHTTPServer.HTTPServer(
+            ('127.0.0.1', 0), UsersXMLHandler,
+        )
+        with open(TEST_DATA_XML) as xmlfile:
+            self.server.xml = xmlfile.read()
+        self.server.requests = []
+        self.server.fail = False
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, args=(0.01,),
+        )
+        self.thread.daemon = True
+        self.thread.start()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'users.xml')
+        self.updates = []
+        self.synchronizer = xmlsync.UsersXMLSynchronizer(
+            'http://127.0.0.1:%d/users.xml' % self.server.server_port,
+            self.path,
+            on_update=lambda: self.updates.append(1),
+        )
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_sync(self):
+        """
+        Testing if file is replaced only when the source has changed.
+        """
+        self.assertTrue(self.synchronizer.sync())
+        with open(self.path) as xmlfile:
+            self.assertEqual(xmlfile.read(), self.server.xml)
+        self.assertFalse(self.synchronizer.sync())
+        self.assertEqual(
+            self.server.requests[1].get('if-none-match'),
+            self.synchronizer.etag,
+        )
+        self.server.xml = self.server.xml.replace('Adam P.', 'Adam Q.')
+        self.assertTrue(self.synchronizer.sync())
+        with open(self.path) as xmlfile:
+            self.assertIn('Adam Q.', xmlfile.read())
+        self.assertEqual(len(self.updates), 2)
+        self.assertEqual(os.listdir(self.directory), ['users.xml'])
+
+    def test_first_sync_unconditional(self):
+        """
+        Testing if a file older than the export is replaced on first sync.
+        """
+        with open(self.path, 'w') as xmlfile:
+            xmlfile.write('bundled')
+        self.assertTrue(self.synchronizer.sync())
+        self.assertNotIn('if-modified-since', self.server.requests[0])
+        with open(self.path) as xmlfile:
+            self.assertEqual(xmlfile.read(), self.server.xml)
+
+    def test_failure(self):
+        """
+        Testing if failed download leaves the file untouched.
+        """
+        with open(self.path, 'w') as xmlfile:
+            xmlfile.write('old')
+        self.server.fail = True
+        self.assertRaises(urllib2.HTTPError, self.synchronizer.sync)
+        with open(self.path) as xmlfile:
+            self.assertEqual(xmlfile.read(), 'old')
+        self.assertEqual(self.updates, [])
+
+    def test_malformed(self):
+        """
+        Testing if a body which isn't well-formed XML is rejected.
+        """
+        self.assertTrue(self.synchronizer.sync())
+        etag = self.synchronizer.etag
+        good = self.server.xml
+        for body in (good[:len(good) // 2], '<html><body>Error</html>'):
+            self.server.xml = body
+            self.assertRaises(
+                xmlsync.etree.XMLSyntaxError, self.synchronizer.sync,
+            )
+            with open(self.path) as xmlfile:
+                self.assertEqual(xmlfile.read(), good)
+            self.assertEqual(self.synchronizer.etag, etag)
+        self.assertEqual(len(self.updates), 1)
+        self.assertEqual(os.listdir(self.directory), ['users.xml'])
+
+    def test_background(self):
+        """
+        Testing scheduled synchronization.
+        """
+        self.synchronizer.start(60)
+        self.synchronizer.stop()
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_update_xml_file(self):
+        """
+        Testing if update_xml_file invalidates cached users.
+        """
+        config = dict(main.app.config)
+        synchronizer = utils.XML_SYNCHRONIZER
+        main.app.config.update({
+            'XML_SOURCE': self.synchronizer.source,
+            'DATA_XML': self.path,
+        })
+        try:
+            self.assertTrue(utils.update_xml_file())
+            self.assertIn(141, utils.get_users()['users'])
+            self.server.xml = self.server.xml.replace('"141"', '"142"')
+            self.assertTrue(utils.update_xml_file())
+            self.assertIn(142, utils.get_users()['users'])
+        finally:
+            main.app.config.clear()
+            main.app.config.update(config)
+            utils.XML_SYNCHRONIZER = synchronizer
+            utils.USERS_DATA.clear()
+
+
+class PresenceAnalyzerBinaryStoreTestCase(unittest.TestCase):
+    """
+    Binary snapshot tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, write snapshot of the test data.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'presence.snapshot')
+        self.store = loader.PresenceCSVLoader().load(TEST_DATA_CSV)
+        binstore.write_snapshot(self.store, self.path)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.directory)
+        main.app.config.update({'DATA_SNAPSHOT': None})
+
+    def test_load(self):
+        """
+        Testing if loaded snapshot equals the written store.
+        """
+        data = binstore.load_snapshot(self.path)
+        self.assertEqual(data, self.store)
+        self.assertEqual(data.version, self.store.version)
+        self.assertEqual(data.keys(), [10, 11])
+        self.assertEqual(data[10], self.store[10])
+        self.assertEqual(data.days[-1], self.store.days[-1])
+        self.assertEqual(list(data.starts), list(self.store.starts))
+        for user_id in data:
+            self.assertEqual(
+                data.aggregates[user_id],
+                self.store.aggregates[user_id],
+            )
+            self.assertEqual(
+                data.weekday_stats(user_id),
+                self.store.weekday_stats(user_id),
+            )
+        self.assertIsNone(data.aggregates.get(12))
+
+    def test_invalid(self):
+        """
+        Testing if other files are rejected.
+        """
+        with open(self.path, 'r+b') as snapshot:
+            snapshot.write('NOTSNAP')
+        self.assertRaises(ValueError, binstore.load_snapshot, self.path)
+        with open(self.path, 'wb') as snapshot:
+            snapshot.write('x' * 100)
+        self.assertRaises(ValueError, binstore.load_snapshot, self.path)
+
+    def test_get_data(self):
+        """
+        Testing if configured snapshot is served by get_data.
+        """
+        main.app.config.update({'DATA_SNAPSHOT': self.path})
+        data = utils.get_data()
+        self.assertIsInstance(data.days, binstore.MappedColumn)
+        self.assertEqual(data, self.store)
+
+
+class PresenceAnalyzerSharedTestCase(unittest.TestCase):
+    """
+    Presence data shared between processes tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.shared_directory = os.path.join(self.directory, 'shared')
+        self.path = os.path.join(self.directory, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.path)
+        # separate flock()s conflict like separate processes
+        self.first = shared.SharedPresence(self.shared_directory)
+        self.second = shared.SharedPresence(self.shared_directory)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        self.first.close()
+        self.second.close()
+        shutil.rmtree(self.directory)
+        main.app.config.update({'SHARED_DATA_DIR': None})
+
+    def test_publish_and_attach(self):
+        """
+        Testing if one process publishes and the other attaches.
+        """
+        self.assertEqual(self.second.read_generation(), 0)
+        signature = self.first.signature(self.path)
+        self.assertTrue(self.first.publisher)
+        published = self.first.load(self.path)
+        self.assertEqual(self.second.signature(self.path), ('reader', 1))
+        self.assertFalse(self.second.publisher)
+        attached = self.second.load(self.path)
+        self.assertIsInstance(attached.days, binstore.MappedColumn)
+        self.assertEqual(attached, published)
+
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-10,09:00:00,17:00:00\n')
+        self.assertNotEqual(self.first.signature(self.path), signature)
+        self.first.load(self.path)
+        self.assertEqual(self.second.signature(self.path), ('reader', 2))
+        self.assertIn(12, self.second.load(self.path))
+        self.assertItemsEqual(
+            os.listdir(self.shared_directory),
+            ['generation', 'publisher.lock',
+             'presence-1.snapshot', 'presence-2.snapshot'],
+        )
+
+    def test_take_over(self):
+        """
+        Testing if another process publishes when the publisher is gone.
+        """
+        self.first.signature(self.path)
+        self.first.load(self.path)
+        self.first.close()
+        self.assertEqual(self.second.signature(self.path)[0], 'publisher')
+        self.second.load(self.path)
+        self.assertEqual(self.second.read_generation(), 2)
+
+    def test_publish_in_background(self):
+        """
+        Testing if the publisher publishes changes without being asked.
+        """
+        self.first.close()
+        self.first = shared.SharedPresence(
+            self.shared_directory, check_interval=0.01,
+        )
+        self.first.load(self.path)
+        self.assertEqual(self.second.read_generation(), 1)
+        self.first.load(self.path)
+        self.assertEqual(self.second.read_generation(), 1)
+
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-10,09:00:00,17:00:00\n')
+        for _ in range(500):
+            if self.second.signature(self.path) == ('reader', 2):
+                break
+            sleep(0.01)
+        self.assertIn(12, self.second.load(self.path))
+
+    def test_nothing_published(self):
+        """
+        Testing if reader parses the CSV until anything is published.
+        """
+        self.first.signature(self.path)
+        self.assertEqual(self.second.load(self.path).keys(), [10, 11])
+
+    def test_get_data(self):
+        """
+        Testing if get_data serves shared data when configured.
+        """
+        main.app.config.update({
+            'SHARED_DATA_DIR': self.shared_directory,
+            'DATA_CSV': self.path,
+        })
+        try:
+            data = utils.get_data()
+            self.assertEqual(data.keys(), [10, 11])
+            self.assertTrue(utils.shared_presence().publisher)
+        finally:
+            utils.shared_presence().close()
+            main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+
+
+class PresenceAnalyzerStoreTestCase(unittest.TestCase):
+    """
+    Columnar presence store tests.
+    """
+
+    def test_build(self):
+        """
+        Testing if builder sorts rows and keeps the last row of a day.
+        """
+        builder = store.PresenceStoreBuilder()
+        builder.add(2, 735000, 100, 200)
+        builder.add(1, 735002, 300, 400)
+        builder.add(1, 735001, 500, 600)
+        builder.add(1, 735002, 700, 800)
+        data = builder.build()
+        self.assertEqual(data.keys(), [1, 2])
+        self.assertEqual(data.rows(), 3)
+        self.assertIn(2, data)
+        self.assertNotIn(3, data)
+        self.assertEqual(
+            [list(column) for column in data.columns(1)],
+            [[735001, 735002], [500, 700], [600, 800]],
+        )
+        self.assertEqual(data.nbytes(), 3 * 3 * data.days.itemsize)
+
+    def test_date_range(self):
+        """
+        Testing if columns and statistics can be limited to a date range.
+        """
+        builder = store.PresenceStoreBuilder()
+        for day in range(735000, 735010):
+            builder.add(1, day, 100, 200)
+        builder.add(2, 735005, 300, 400)
+        data = builder.build()
+        self.assertEqual(
+            list(data.columns(1, 735003, 735005)[0]),
+            [735003, 735004, 735005],
+        )
+        self.assertEqual(list(data.columns(1, first=735008)[0]),
+                         [735008, 735009])
+        self.assertEqual(list(data.columns(1, last=734999)[0]), [])
+        self.assertEqual(list(data.columns(2, 735000, 735100)[2]), [400])
+        stats = data.weekday_stats(1, 735003, 735005)
+        self.assertEqual(sum(day['count'] for day in stats), 3)
+        self.assertEqual(sum(day['count'] for day in data.weekday_stats(1)),
+                         10)
+
+    def test_legacy_layout(self):
+        """
+        Testing if single user can be read in the nested dict layout.
+        """
+        builder = store.PresenceStoreBuilder()
+        builder.add(1, datetime.date(2013, 9, 10).toordinal(), 34745, 64792)
+        self.assertEqual(
+            builder.build()[1],
+            {
+                datetime.date(2013, 9, 10): {
+                    'start': datetime.time(9, 39, 5),
+                    'end': datetime.time(17, 59, 52),
+                },
+            },
+        )
+
+    def test_weekday_of(self):
+        """
+        Testing weekday calculation from date ordinal.
+        """
+        for day in range(7):
+            date = datetime.date(2013, 9, 9) + datetime.timedelta(days=day)
+            self.assertEqual(
+                store.weekday_of(date.toordinal()),
+                date.weekday(),
+            )
+
+
+class PresenceAnalyzerAggregatesTestCase(unittest.TestCase):
+    """
+    Weekday aggregation tests.
+    """
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+
+    def test_weekday_stats(self):
+        """
+        Testing if weekday statistics match the per date grouping.
+        """
+        data = utils.get_data()
+        weekdays = aggregates.expand_totals(
+            aggregates.weekday_totals(*data.columns(10)),
+        )
+        self.assertEqual(len(weekdays), 7)
+        grouped = utils.group_by_weekday(data[10])
+        grouped_in_secs = utils.group_by_weekday_in_secs(data[10])
+        for weekday, stats in enumerate(weekdays):
+            self.assertEqual(stats['count'], len(grouped[weekday]))
+            self.assertEqual(
+                stats['duration']['mean'],
+                utils.mean(grouped[weekday]),
+            )
+            self.assertEqual(
+                stats['duration']['sum'],
+                sum(grouped[weekday]),
+            )
+            self.assertEqual(
+                stats['start']['mean'],
+                utils.mean(grouped_in_secs[weekday]['start']),
+            )
+        self.assertEqual(weekdays[1]['end']['max'], 64792)
+        self.assertEqual(weekdays[1]['start']['min'], 34745)
+        self.assertIsNone(weekdays[0]['duration']['min'])
+
+    def test_weekday_totals(self):
+        """
+        Testing compact weekday totals layout.
+        """
+        data = utils.get_data()
+        totals = aggregates.weekday_totals(*data.columns(10))
+        self.assertEqual(len(totals), 7)
+        self.assertEqual(
+            dict(zip(aggregates.TOTALS_LAYOUT, totals[1])),
+            {
+                'count': 1,
+                'duration_sum': 30047,
+                'start_sum': 34745,
+                'end_sum': 64792,
+                'duration_min': 30047,
+                'duration_max': 30047,
+                'start_min': 34745,
+                'start_max': 34745,
+                'end_min': 64792,
+                'end_max': 64792,
+            },
+        )
+        self.assertEqual(totals[0], (0, 0, 0, 0) + (None,) * 6)
+        self.assertEqual(aggregates.expand_totals(totals)[1]['count'], 1)
+
+    def test_group_by_weekday(self):
+        """
+        Testing partitioning of rows by weekday.
+        """
+        monday = datetime.date(2013, 9, 9).toordinal()
+        groups = aggregates.group_by_weekday(
+            [monday, monday + 2, monday + 7], [100, 200, 300], [150, 260, 390],
+        )
+        self.assertEqual(len(groups), 7)
+        self.assertEqual(groups[0], ([50, 90], [100, 300], [150, 390]))
+        self.assertEqual(groups[2], ([60], [200], [260]))
+        self.assertEqual(groups[1], ([], [], []))
+
+    def test_summarize(self):
+        """
+        Testing weekday statistics of many users with percentiles.
+        """
+        builder = store.PresenceStoreBuilder()
+        monday = datetime.date(2013, 9, 9).toordinal()
+        for week, (start, end) in enumerate([(100, 50), (0, 300), (10, 30)]):
+            builder.add(1, monday + 7 * week, start, end)
+        builder.add(2, monday, 200, 600)
+        builder.add(2, monday + 1, 0, 86399)
+        data = builder.build()
+
+        weekdays = aggregates.summarize(data)
+        self.assertEqual(len(weekdays), 7)
+        self.assertEqual(weekdays[0]['users'], 2)
+        self.assertEqual(weekdays[0]['count'], 4)
+        # percentiles of the whole history come from merged sketches
+        self.assertEqual(weekdays[0]['duration'], {
+            'count': 4, 'sum': 670, 'mean': 167.5, 'min': -50, 'max': 400,
+            'p10': -30, 'p50': 330, 'p90': 390,
+        })
+        self.assertEqual(weekdays[0]['start']['p50'], 90)
+        self.assertEqual(weekdays[0]['end']['mean'], 245.0)
+        self.assertEqual(weekdays[1]['users'], 1)
+        self.assertEqual(weekdays[1]['end']['max'], 86399)
+        self.assertEqual(weekdays[2]['count'], 0)
+        self.assertEqual(weekdays[2]['duration']['p90'], 0)
+        self.assertIsNone(weekdays[2]['start']['min'])
+
+        weekdays = aggregates.summarize(data, users=[1, 3], last=monday + 7)
+        self.assertEqual(weekdays[0]['users'], 1)
+        self.assertEqual(weekdays[0]['duration']['sum'], 250)
+        self.assertEqual(weekdays[0]['duration']['p50'], 300)
+        self.assertEqual(weekdays[1]['count'], 0)
+
+        everything = aggregates.summarize(data, first=0)
+        weekdays = aggregates.summarize(data)
+        for exact, merged in zip(everything, weekdays):
+            self.assertEqual(exact['users'], merged['users'])
+            for field in aggregates.FIELDS:
+                for key in ('count', 'sum', 'mean', 'min', 'max'):
+                    self.assertEqual(exact[field][key], merged[field][key])
+
+
+class PresenceAnalyzerSketchTestCase(unittest.TestCase):
+    """
+    Quantile sketch tests.
+    """
+
+    def test_quantile(self):
+        """
+        Testing quantiles within the sketch resolution.
+        """
+        values = range(0, 36000, 7)
+        quantiles = sketch.QuantileSketch(values)
+        self.assertEqual(len(quantiles), len(values))
+        for fraction in (0, 0.1, 0.5, 0.9, 1):
+            exact = benchmarks.percentile(values, fraction)
+            self.assertLessEqual(
+                abs(quantiles.quantile(fraction) - exact),
+                sketch.RESOLUTION,
+            )
+        self.assertEqual(sketch.QuantileSketch([-1]).quantile(0.5), -30)
+        self.assertEqual(sketch.QuantileSketch().quantile(0.5), 0)
+
+    def test_merge(self):
+        """
+        Testing if merged sketch equals the sketch of all values.
+        """
+        first = sketch.QuantileSketch([100, 4000, 4000])
+        second = sketch.QuantileSketch([-600, 9000])
+        merged = first.merged(second)
+        self.assertEqual(merged, sketch.QuantileSketch(
+            [100, 4000, 4000, -600, 9000]
+        ))
+        self.assertEqual(len(merged), 5)
+        self.assertEqual(len(first), 3)
+        self.assertEqual(merged.quantile(0.5), 4000 // 60 * 60 + 30)
+        self.assertEqual(merged.quantile(0), -600 + 30)
+        self.assertEqual(merged.quantile(1), 9000 + 30)
+        self.assertEqual(sketch.QuantileSketch().merged(first), first)
+        self.assertEqual(second.merged(first), merged)
+
+    def test_merge_sketches(self):
+        """
+        Testing if sketches merged at once equal the pairwise merged ones.
+        """
+        sketches = [
+            sketch.QuantileSketch([100, 4000, 4000]),
+            sketch.QuantileSketch(),
+            sketch.QuantileSketch([-600, 9000]),
+            sketch.QuantileSketch([3000]),
+        ]
+        expected = sketch.QuantileSketch()
+        for other in sketches:
+            expected = expected.merged(other)
+        self.assertEqual(sketch.merge_sketches(sketches), expected)
+        self.assertEqual(len(sketch.merge_sketches([])), 0)
+
+    def test_weekday_stats(self):
+        """
+        Testing percentiles in store weekday statistics.
+        """
+        builder = store.PresenceStoreBuilder()
+        monday = datetime.date(2013, 9, 9).toordinal()
+        for week, start in enumerate([28800, 29000, 45000]):
+            builder.add(1, monday + 7 * week, start, 57600)
+        data = builder.build()
+        weekdays = data.weekday_stats(1, percentiles=(10, 50))
+        self.assertEqual(weekdays[0]['start']['p50'], 29010)
+        self.assertEqual(weekdays[0]['start']['p10'], 28830)
+        self.assertEqual(weekdays[0]['end']['p50'], 57630)
+        self.assertEqual(weekdays[0]['duration']['p50'], 28590)
+        self.assertEqual(weekdays[1]['start']['p50'], 0)
+        self.assertIn(1, data.sketches)
+        weekdays = data.weekday_stats(1, first=monday + 14, percentiles=(50,))
+        self.assertEqual(weekdays[0]['start']['p50'], 45030)
+        self.assertNotIn('p50', data.weekday_stats(1)[0]['start'])
+
+
+class PresenceAnalyzerCSVParserTestCase(unittest.TestCase):
+    """
+    Presence CSV parser tests.
+    """
+
+    def test_parse_day(self):
+        """
+        Testing date decoding.
+        """
+        self.assertEqual(
+            csvparser.parse_day('2013-09-10'),
+            datetime.date(2013, 9, 10).toordinal(),
+        )
+        for text in ('2013-9-10', '2013/09/10', '2013-13-01', ''):
+            self.assertRaises(ValueError, csvparser.parse_day, text)
+
+    def test_parse_seconds(self):
+        """
+        Testing time decoding.
+        """
+        self.assertEqual(csvparser.parse_seconds('09:39:05'), 34745)
+        self.assertEqual(csvparser.parse_seconds('00:00:00'), 0)
+        for text in ('9:39:05', '09-39-05', '24:00:00', '09:60:00', 'xx'):
+            self.assertRaises(ValueError, csvparser.parse_seconds, text)
+
+    def test_parse(self):
+        """
+        Testing if malformed and header lines are skipped.
+        """
+        builder = store.PresenceStoreBuilder()
+        rows = csvparser.PresenceCSVParser().parse(
+            [
+                'user_id,date,start,end\n',
+                '10,2013-09-10,09:39:05,17:59:52\r\n',
+                '10,2013-09-11,bad,17:59:52\n',
+                'x,2013-09-11,09:39:05,17:59:52\n',
+                '11,2013-09-10,09:39:05,17:59:52\n',
+                '\n',
+            ],
+            builder,
+        )
+        data = builder.build()
+        self.assertEqual(rows, 2)
+        self.assertEqual(data.keys(), [10, 11])
+        self.assertEqual(
+            data[10].keys(),
+            [datetime.date(2013, 9, 10)],
+        )
+
+
+class PresenceAnalyzerLoaderTestCase(unittest.TestCase):
+    """
+    Incremental CSV loader tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data.csv')
+        self.loader = loader.PresenceCSVLoader()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.directory)
+
+    def write(self, text, mode='a'):
+        """
+        Writes text to the data file.
+        """
+        with open(self.path, mode) as csvfile:
+            csvfile.write(text)
+
+    def test_unchanged(self):
+        """
+        Testing if unchanged file isn't parsed again.
+        """
+        self.write('10,2013-09-10,09:39:05,17:59:52\n')
+        data = self.loader.load(self.path)
+        self.assertIs(self.loader.load(self.path), data)
+        self.assertEqual(
+            data.version,
+            loader.signature_version(loader.file_signature(self.path)),
+        )
+
+    def test_append(self):
+        """
+        Testing if only appended rows are parsed.
+        """
+        self.write('10,2013-09-10,09:39:05,17:59:52\n')
+        data = self.loader.load(self.path)
+        self.write('11,2013-09-10,09:00:00,17:00:00\n10,2013-09-11,')
+        self.assertEqual(self.loader.load(self.path).keys(), [10, 11])
+        self.assertEqual(self.loader.offset, 64)
+        self.write('09:00:00,17:00:00\n')
+        new_data = self.loader.load(self.path)
+        self.assertEqual(new_data.rows(), 3)
+        self.assertEqual(list(new_data.columns(10)[1]), [34745, 32400])
+        self.assertEqual(data.rows(), 1)
+        self.assertNotEqual(data.version, new_data.version)
+
+    def test_unterminated_line(self):
+        """
+        Testing if unterminated last line is parsed and parsed again.
+        """
+        self.write('10,2013-09-10,09:39:05,17:59:52')
+        self.assertEqual(self.loader.load(self.path).rows(), 1)
+        self.write('\n10,2013-09-11,09:39:05,17:59:52\n')
+        self.assertEqual(self.loader.load(self.path).rows(), 2)
+
+    def test_replaced(self):
+        """
+        Testing if truncated or rewritten file is parsed from scratch.
+        """
+        self.write('10,2013-09-10,09:39:05,17:59:52\n' * 3)
+        self.loader.load(self.path)
+        self.write('11,2013-09-10,09:39:05,17:59:52\n', mode='w')
+        self.assertEqual(self.loader.load(self.path).keys(), [11])
+        self.write('12,2013-09-10,09:39:05,17:59:52\n' * 2, mode='w')
+        self.assertEqual(self.loader.load(self.path).keys(), [12])
+
+    def test_aggregates(self):
+        """
+        Testing if weekday totals are recomputed only for changed users.
+        """
+        self.write(
+            '10,2013-09-10,09:39:05,17:59:52\n'
+            '11,2013-09-10,09:00:00,17:00:00\n'
+        )
+        data = self.loader.load(self.path)
+        self.assertItemsEqual(data.aggregates.keys(), [10, 11])
+        self.write('10,2013-09-17,09:00:00,17:00:00\n')
+        new_data = self.loader.load(self.path)
+        self.assertIs(new_data.aggregates[11], data.aggregates[11])
+        self.assertEqual(new_data.aggregates[10][1][0], 2)
+        self.assertEqual(
+            new_data.weekday_stats(10),
+            aggregates.expand_totals(
+                aggregates.weekday_totals(*new_data.columns(10)),
+            ),
+        )
+
+    def test_sketches(self):
+        """
+        Testing if sketches of appended rows are merged into previous ones.
+        """
+        self.write(
+            '10,2013-09-10,09:39:05,17:59:52\n'
+            '11,2013-09-10,09:00:00,17:00:00\n'
+            '12,2013-09-10,09:00:00,17:00:00\n'
+        )
+        data = self.loader.load(self.path)
+        self.write(
+            '10,2013-09-17,09:00:00,17:00:00\n'
+            '12,2013-09-09,08:00:00,16:00:00\n'
+        )
+        new_data = self.loader.load(self.path)
+        self.assertIs(new_data.sketches[11], data.sketches[11])
+        for user_id in (10, 12):
+            self.assertEqual(
+                new_data.sketches[user_id],
+                sketch.weekday_sketches(*new_data.columns(user_id)),
+            )
+        self.assertEqual(len(new_data.sketches[10][1][0]), 2)
+
+    def test_failure(self):
+        """
+        Testing if loader starts over after a failed load.
+        """
+        self.write('10,2013-09-10,09:39:05,17:59:52\n')
+        self.loader.load(self.path)
+        os.remove(self.path)
+        self.assertRaises(IOError, self.loader.load, self.path)
+        self.assertIsNone(self.loader.store)
+
+
+class PresenceAnalyzerPartitionsTestCase(unittest.TestCase):
+    """
+    Partitioned CSV loader tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.loader = partitions.PartitionedCSVLoader(processes=2)
+        self.write('2013-09.csv', '10,2013-09-10,09:39:05,17:59:52\n')
+        self.write('2013-10.csv', '10,2013-10-01,09:00:00,17:00:00\n')
+        self.write('2013-11.csv', '11,2013-11-05,08:00:00,16:00:00\n')
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.directory)
+
+    def write(self, name, text):
+        """
+        Writes a partition file.
+        """
+        with open(os.path.join(self.directory, name), 'w') as csvfile:
+            csvfile.write(text)
+
+    def test_paths(self):
+        """
+        Testing partition sources and their signatures.
+        """
+        self.write('notes.txt', '')
+        self.assertTrue(partitions.is_partitioned(self.directory))
+        self.assertFalse(partitions.is_partitioned(TEST_DATA_CSV))
+        self.assertEqual(
+            [os.path.basename(path)
+             for path in partitions.partition_paths(self.directory)],
+            ['2013-09.csv', '2013-10.csv', '2013-11.csv'],
+        )
+        pattern = os.path.join(self.directory, '2013-1*.csv')
+        self.assertTrue(partitions.is_partitioned(pattern))
+        self.assertEqual(len(partitions.partition_paths(pattern)), 2)
+        self.assertEqual(len(partitions.source_signature(pattern)[1]), 2)
+        self.assertEqual(partitions.source_signature(TEST_DATA_CSV)[0],
+                         TEST_DATA_CSV)
+
+    def test_load(self):
+        """
+        Testing if partitions are parsed in parallel and merged.
+        """
+        data = self.loader.load(self.directory)
+        self.assertEqual(data.keys(), [10, 11])
+        self.assertEqual(
+            list(data.columns(10)[0]),
+            [datetime.date(2013, 9, 10).toordinal(),
+             datetime.date(2013, 10, 1).toordinal()],
+        )
+        self.assertEqual(data.aggregates[10][1][0], 2)
+        self.assertEqual(
+            data.weekday_stats(10, percentiles=(50,))[1]['end']['p50'],
+            64770,
+        )
+        self.assertIs(self.loader.load(self.directory), data)
+
+    def test_reload(self):
+        """
+        Testing if only changed partitions are parsed again.
+        """
+        data = self.loader.load(self.directory)
+        parsed = dict(
+            (path, part) for path, (_, part)
+            in self.loader.partitions.iteritems()
+        )
+        self.write('2013-11.csv', (
+            '11,2013-11-05,08:00:00,16:00:00\n'
+            '11,2013-11-06,08:00:00,16:00:00\n'
+            '10,2013-09-10,10:00:00,18:00:00\n'
+        ))
+        os.utime(os.path.join(self.directory, '2013-11.csv'), (0, 0))
+        os.remove(os.path.join(self.directory, '2013-10.csv'))
+        new_data = self.loader.load(self.directory)
+        self.assertNotEqual(new_data.version, data.version)
+        self.assertEqual(len(self.loader.partitions), 2)
+        first = os.path.join(self.directory, '2013-09.csv')
+        self.assertIs(self.loader.partitions[first][1], parsed[first])
+        # the later partition wins
+        self.assertEqual(list(new_data.columns(10)[1]), [36000])
+        self.assertEqual(new_data.rows(), 3)
+        self.assertEqual(
+            new_data.aggregates[11],
+            aggregates.weekday_totals(*new_data.columns(11)),
+        )
+
+    def test_pool(self):
+        """
+        Testing if the pool created up front is reused by reloads.
+        """
+        self.loader.start()
+        try:
+            pool = self.loader.pool
+            self.assertIsNotNone(pool)
+            self.loader.start()
+            self.assertIs(self.loader.pool, pool)
+            data = self.loader.load(self.directory)
+            self.assertEqual(data.keys(), [10, 11])
+            self.write('2013-10.csv', '12,2013-10-01,09:00:00,17:00:00\n')
+            self.write('2013-12.csv', '12,2013-12-02,09:00:00,17:00:00\n')
+            os.utime(os.path.join(self.directory, '2013-10.csv'), (0, 0))
+            self.assertEqual(
+                self.loader.load(self.directory).keys(), [10, 11, 12],
+            )
+            self.assertIs(self.loader.pool, pool)
+        finally:
+            self.loader.close()
+        self.assertIsNone(self.loader.pool)
+
+    def test_single_file(self):
+        """
+        Testing if a single file is loaded incrementally.
+        """
+        data = self.loader.load(TEST_DATA_CSV)
+        self.assertIs(self.loader.file_loader.store, data)
+        self.assertEqual(data.keys(), [10, 11])
+
+    def test_get_data(self):
+        """
+        Testing if get_data() serves partitions.
+        """
+        main.app.config.update({'DATA_CSV': self.directory})
+        try:
+            self.assertEqual(utils.get_data().keys(), [10, 11])
+        finally:
+            main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+
+
+class PresenceAnalyzerBenchmarksTestCase(unittest.TestCase):
+    """
+    Benchmark suite tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.config = dict(main.app.config)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.update(self.config)
+        utils.PRESENCE_LOADER.reset()
+        for cache in utils.CACHES.values():
+            cache.clear()
+        shutil.rmtree(self.directory)
+
+    def test_compare(self):
+        """
+        Test ratios of results to a baseline.
+        """
+        self.assertEqual(
+            benchmarks.compare(
+                {'a': 3, 'b': 1.0, 'c': 2, 'd': 'x'},
+                {'a': 2, 'b': 0, 'd': 'x'},
+            ),
+            {'a': 1.5},
+        )
+
+    def test_suite_output(self):
+        """
+        Test results of the suite saved as JSON.
+        """
+        path = os.path.join(self.directory, 'results.json')
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            benchmarks.main([
+                'suite', '--users', '5', '--years', '0.1',
+                '--concurrency', '1,2', '--seconds', '0.05',
+                '--output', path,
+            ])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertIn('micro.get_data_warm_us', output)
+        with open(path) as results:
+            data = json.load(results)
+        self.assertEqual(data['benchmark'], 'suite')
+        self.assertEqual(data['users'], 5)
+        results = data['results']
+        for name in ('get_data_warm_us', 'group_by_weekday_us',
+                     'parse_users_xml_cold_us',
+                     'cached_json_users_miss_us',
+                     'cached_json_start_end_hit_us'):
+            self.assertGreater(results['micro.' + name], 0)
+        for level in (1, 2):
+            self.assertGreater(
+                results['e2e.c%d_requests_per_second' % level], 0,
+            )
+            self.assertEqual(results['e2e.c%d_errors' % level], 0)
+
+
+class QuietWSGIRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+    """
+    Request handler of the load tested server, not logging requests.
+    """
+
+    def log_message(self, *args):
+        """
+        Skips logging.
+        """
+        pass
+
+
+class PresenceAnalyzerLoadTestTestCase(unittest.TestCase):
+    """
+    Load test harness tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+        self.server = wsgiref.simple_server.make_server(
+            '127.0.0.1', 0, main.app,
+            handler_class=QuietWSGIRequestHandler,
+        )
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_parse_mix(self):
+        """
+        Test parsing of the request mix.
+        """
+        self.assertEqual(
+            loadtest.parse_mix('users=1, presence_weekday=3,presence_summary'),
+            [('users', 1), ('presence_weekday', 3), ('presence_summary', 1)],
+        )
+        self.assertRaises(ValueError, loadtest.parse_mix, 'unknown=1')
+
+    def test_request_mix(self):
+        """
+        Test drawing of request paths.
+        """
+        mix = loadtest.RequestMix([('presence_weekday', 1)], [10])
+        rnd = random.Random(0)
+        self.assertEqual(mix.path(rnd), '/api/v1/presence_weekday/10')
+        mix = loadtest.RequestMix([('presence_weekday', 1)], [])
+        self.assertEqual(mix.path(rnd), '/api/v1/users')
+
+    def test_run_level(self):
+        """
+        Test throughput and latencies measured against a server.
+        """
+        self.assertEqual(
+            sorted(loadtest.user_ids_of(self.url)), [26, 141, 165, 170, 176],
+        )
+        mix = loadtest.RequestMix(loadtest.parse_mix(loadtest.MIX), [10, 11])
+        result = loadtest.run_level(self.url, mix, 2, 0.2)
+        self.assertEqual(result['clients'], 2)
+        self.assertEqual(result['errors'], 0)
+        self.assertGreater(result['requests'], 0)
+        self.assertGreater(result['requests_per_second'], 0)
+        self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+        self.assertLessEqual(result['p99_ms'], result['max_ms'])
+        self.assertEqual(
+            len(loadtest.format_level(result)),
+            len(loadtest.report_header()),
+        )
+
+    def test_main(self):
+        """
+        Test load test of a running server saved as JSON.
+        """
+        directory = tempfile.mkdtemp()
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            path = os.path.join(directory, 'results.json')
+            loadtest.main([
+                '--url', self.url, '--clients', '1,2', '--seconds', '0.05',
+                '--output', path,
+            ])
+            output = sys.stdout.getvalue()
+            with open(path) as results:
+                data = json.load(results)
+        finally:
+            sys.stdout = stdout
+            shutil.rmtree(directory)
+        self.assertEqual(
+            output.splitlines()[0], loadtest.report_header(),
+        )
+        self.assertEqual(
+            [result['clients'] for result in data['results']], [1, 2],
+        )
+        self.assertEqual(data['url'], self.url)
+
+    def test_serve(self):
+        """
+        Test serving by the Paste server and shutting it down.
+        """
+        server = loadtest.serve(main.app, workers=2, spawn_if_under=5)
+        try:
+            url = 'http://127.0.0.1:%d' % server.server_port
+            self.assertIn(26, loadtest.user_ids_of(url))
+            self.assertEqual(server.thread_pool.spawn_if_under, 2)
+        finally:
+            started = time.time()
+            loadtest.shutdown(server)
+        self.assertLess(time.time() - started, 1)
+        self.assertFalse(server.thread.is_alive())
+        self.assertEqual(server.thread_pool.workers, [])
+
+    def test_main_serves(self):
+        """
+        Test load test of a started server without background jobs.
+        """
+        directory = tempfile.mkdtemp()
+        config = dict(main.app.config)
+        synchronizer = utils.XML_SYNCHRONIZER
+        warm_up = utils.WARM_UP
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            config_path = os.path.join(directory, 'deploy.cfg')
+            with open(config_path, 'w') as config_file:
+                config_file.write(
+                    'DATA_CSV = %r\nDATA_XML = %r\nXML_SOURCE = %r\n'
+                    'XML_SYNC_INTERVAL = 60\nWARM_UP = True\n' % (
+                        TEST_DATA_CSV, TEST_DATA_XML,
+                        'http://127.0.0.1:1/users.xml',
+                    )
+                )
+            path = os.path.join(directory, 'results.json')
+            loadtest.main([
+                '--config', config_path, '--workers', '2',
+                '--clients', '1', '--seconds', '0.05', '--output', path,
+            ])
+            with open(path) as results:
+                data = json.load(results)
+            self.assertIs(utils.XML_SYNCHRONIZER, synchronizer)
+            self.assertIs(utils.WARM_UP, warm_up)
+        finally:
+            sys.stdout = stdout
+            shutil.rmtree(directory)
+            main.app.config.clear()
+            main.app.config.update(config)
+        self.assertTrue(data['url'].startswith('http://127.0.0.1:'))
+        self.assertEqual(data['spawn_if_under'], 2)
+        self.assertEqual(data['results'][0]['errors'], 0)
+
+
+class PresenceAnalyzerWarmUpTestCase(unittest.TestCase):
+    """
+    Warm-up and readiness tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        utils.WARM_UP = None
+
+    def test_tasks(self):
+        """
+        Test tasks running in parallel and failures being recorded.
+        """
+        barrier = threading.Event()
+
+        def first():
+            """
+            Waits for the second task.
+            """
+            if not barrier.wait(5):
+                raise AssertionError('Tasks run one by one')
+
+        def failing():
+            """
+            Unblocks the first task and fails.
+            """
+            barrier.set()
+            raise ValueError('broken')
+
+        warm_up = warmup.WarmUp(
+            main.app, [('first', first), ('failing', failing)],
+        )
+        self.assertEqual(warm_up.state(), 'pending')
+        warm_up.start()
+        self.assertTrue(warm_up.wait(5))
+        self.assertEqual(warm_up.state(), 'ready')
+        self.assertEqual(warm_up.errors, {'failing': 'ValueError: broken'})
+        self.assertGreaterEqual(warm_up.status()['seconds'], 0)
+
+    def test_warm_up(self):
+        """
+        Test loading of data sources and caching of urls.
+        """
+        utils.PRESENCE_DATA.clear()
+        utils.USERS_DATA.clear()
+        warm_up = utils.warm_up()
+        self.assertIs(utils.warm_up(), warm_up)
+        self.assertEqual(warm_up.urls, list(main.app.config['WARM_UP_URLS']))
+        warm_up.start()
+        self.assertTrue(warm_up.wait(10))
+        self.assertEqual(warm_up.status()['state'], 'ready')
+        self.assertEqual(warm_up.errors, {})
+        self.assertEqual(sorted(utils.get_data().keys()), [10, 11])
+        self.assertIsNotNone(utils.USERS_DATA.current)
+
+    def test_ready_view(self):
+        """
+        Test readiness reported during and after warm-up.
+        """
+        resp = self.client.get('/ready')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data)['state'], 'ready')
+
+        release = threading.Event()
+        utils.WARM_UP = warmup.WarmUp(main.app, [('slow', release.wait)])
+        utils.WARM_UP.start()
+        resp = self.client.get('/ready')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(json.loads(resp.data)['state'], 'running')
+
+        release.set()
+        self.assertTrue(utils.WARM_UP.wait(5))
+        resp = self.client.get('/ready')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data['state'], 'ready')
+        self.assertEqual(data['errors'], {})
+
+        def failing():
+            """
+            Fails like a transient error.
+            """
+            raise IOError('unavailable')
+
+        utils.WARM_UP = warmup.WarmUp(main.app, [('users', failing)])
+        utils.WARM_UP.start()
+        self.assertTrue(utils.WARM_UP.wait(5))
+        resp = self.client.get('/ready')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'application/json')
+        self.assertEqual(
+            json.loads(resp.data)['errors'], {'users': 'IOError: unavailable'},
+        )
 
 
 def suite():
@@ -320,6 +2111,22 @@ def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerMetricsTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerProfilingTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerLRUCacheTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerSnapshotCacheTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerXMLSyncTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerBinaryStoreTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerSharedTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerStoreTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerAggregatesTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerSketchTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerCSVParserTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerLoaderTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerPartitionsTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerBenchmarksTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerLoadTestTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerWarmUpTestCase))
     return suite
 
 
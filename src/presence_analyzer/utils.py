@@ -3,116 +3,274 @@
 Helper functions used in views.
 """
 
-import csv
+import hashlib
+import os
 import xml
-import urllib2
-import time
-import threading
 from json import dumps
 from functools import wraps
-from datetime import datetime
 from lxml import etree
-from flask import Response
+from flask import Response, abort, request
 import logging
 
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
 
 from presence_analyzer.main import app
-CACHE = {}
-TIMESTAMPS = {}
-LOCKER = threading.Lock()
+from presence_analyzer import collation, metrics
+from presence_analyzer.binstore import load_snapshot
+from presence_analyzer.csvparser import parse_day
+from presence_analyzer.loader import file_signature, signature_version
+from presence_analyzer.lrucache import LRUCache
+from presence_analyzer.partitions import (
+    PartitionedCSVLoader, source_signature,
+)
+from presence_analyzer.refresher import SnapshotCache
+from presence_analyzer.shared import SharedPresence
+from presence_analyzer.warmup import WarmUp
+from presence_analyzer.xmlsync import UsersXMLSynchronizer
+CACHES = {}
+PRESENCE_LOADER = PartitionedCSVLoader()
+XML_SYNCHRONIZER = None
+WARM_UP = None
+SHARED_PRESENCE = None
+# memory bound of the encoded responses cached per view, see cached_json
+RESPONSE_CACHE_BYTES = 16 * 1024 * 1024
 
 
-def jsonify(function):
+def register_cache(function, max_entries=None, max_bytes=None):
     """
-    Creates a response with the JSON representation of wrapped function result.
+    Creates LRU namespace for results of given function.
     """
-    @wraps(function)
-    def inner(*args, **kwargs):
-        return Response(dumps(function(*args, **kwargs)),
-                        mimetype='application/json')
-    return inner
+    name = '{}.{}'.format(function.__module__, function.__name__)
+    namespace = CACHES[name] = LRUCache(name, max_entries, max_bytes)
+    return namespace
 
 
-def cache(key, seconds):
+def cached_json(version, max_entries=1000, max_bytes=RESPONSE_CACHE_BYTES):
     """
-    Cache
+    Creates a JSON response of the wrapped function result, answering
+    conditional requests.
+
+    Encoded bodies are cached per call arguments, query string and
+    version(), the version of the data they are computed from. Every
+    response carries a strong ETag derived from all of them; a request with
+    matching If-None-Match gets 304 Not Modified without a body. Once the
+    version changes, bodies of the previous one are dropped.
     """
-    def _cache(function):
-        def __cache(*args, **kwargs):
+    def _cached_json(function):
+        namespace = register_cache(function, max_entries, max_bytes)
+        # version of the cached bodies
+        current = [None]
+
+        @wraps(function)
+        def inner(*args, **kwargs):
             """
-            Function that checks if we have already cached items or not
-            If we do, it returns cached items, if not adds them to cache dict.
+            Returns cached or freshly encoded response.
             """
-            now = datetime.now()
-            timestamp = time.mktime(now.timetuple())
-            if key in CACHE:
-                if timestamp < TIMESTAMPS.get(key, 0):
-                    return CACHE[key]
+            key = (
+                version(),
+                args,
+                tuple(sorted(kwargs.items())),
+                request.query_string,
+            )
+            if key[0] != current[0]:
+                current[0] = key[0]
+                namespace.clear()
+            cached = namespace.get(key)
+            if cached is None:
+                etag = hashlib.md5(
+                    repr((function.__name__,) + key)
+                ).hexdigest()
+                result = function(*args, **kwargs)
+                with metrics.STAGE_SECONDS.time('encode'):
+                    cached = (dumps(result), etag)
+                namespace.set(key, cached)
+
+            body, etag = cached
+            response = Response(body, mimetype='application/json')
+            response.set_etag(etag)
+            return response.make_conditional(request)
 
-            result = function(*args, **kwargs)
-            CACHE[key] = result
-            expired_timestamp = timestamp + seconds
-            TIMESTAMPS[key] = expired_timestamp
-            return CACHE[key]
+        inner.cache = namespace
+        return inner
+    return _cached_json
 
-        return __cache
-    return _cache
 
+PRESENCE_DATA = CACHES['presence_data'] = SnapshotCache(
+    'presence_data', PRESENCE_LOADER.load, source_signature,
+)
+SNAPSHOT_DATA = CACHES['presence_snapshot'] = SnapshotCache(
+    'presence_snapshot', load_snapshot, file_signature,
+)
 
-def locking(function):
+
+def shared_presence():
+    """
+    Returns SharedPresence of app.config['SHARED_DATA_DIR'].
     """
-    Decorator used for multi-threading
+    global SHARED_PRESENCE  # pylint: disable-msg=W0603
+    directory = app.config['SHARED_DATA_DIR']
+    shared = SHARED_PRESENCE
+    if shared is None or shared.directory != directory:
+        if shared is not None:
+            shared.close()
+        shared = SHARED_PRESENCE = SharedPresence(
+            directory, app.config['CACHE_CHECK_INTERVAL'],
+        )
+    return shared
+
+
+SHARED_DATA = CACHES['presence_shared'] = SnapshotCache(
+    'presence_shared',
+    lambda path: shared_presence().load(path),
+    lambda path: shared_presence().signature(path),
+)
+
+
+def cache_stats(counter):
     """
-    def __locking(*args, **kwargs):
-        """
-        Locker used for multi-threading
-        """
-        with LOCKER:
-            result = function(*args, **kwargs)
-            return result
-    return __locking
+    Returns {(cache name,): value} of given stats() counter of CACHES.
+
+    Caches which don't count it are left out.
+    """
+    result = {}
+    for name, cache in CACHES.items():
+        stats = cache.stats()
+        if counter in stats:
+            result[(name,)] = stats[counter]
+    return result
+
+
+def cache_hit_ratio():
+    """
+    Returns {(cache name,): hits / lookups} of CACHES used so far.
+    """
+    result = {}
+    for name, cache in CACHES.items():
+        stats = cache.stats()
+        lookups = stats['hits'] + stats['misses']
+        if lookups:
+            result[(name,)] = float(stats['hits']) / lookups
+    return result
+
+
+for _counter in ('hits', 'misses', 'evictions'):
+    metrics.REGISTRY.register(metrics.Collected(
+        'presence_cache_%s_total' % _counter,
+        'Number of cache %s, by cache.' % _counter,
+        ('cache',),
+        lambda counter=_counter: cache_stats(counter),
+        kind='counter',
+    ))
+metrics.REGISTRY.register(metrics.Collected(
+    'presence_cache_hit_ratio',
+    'Fraction of cache lookups which were hits, by cache.',
+    ('cache',),
+    cache_hit_ratio,
+))
 
 
-@locking
-@cache(key='user_id', seconds=10)
 def get_data():
     """
-    Extracts presence data from CSV file and groups it by user_id.
-
-    It creates structure like this:
-    data = {
-        'user_id': {
-            datetime.date(2013, 10, 1): {
-                'start': datetime.time(9, 0, 0),
-                'end': datetime.time(17, 30, 0),
-            },
-            datetime.date(2013, 10, 2): {
-                'start': datetime.time(8, 30, 0),
-                'end': datetime.time(16, 45, 0),
-            },
-        }
+    Extracts presence data from CSV file into a columnar PresenceStore.
+
+    Each user's rows are kept sorted by day in flat integer columns:
+    store.columns(user_id) == (
+        array('i', [735121, 735122]),  # days, date.toordinal()
+        array('i', [32400, 30600]),  # starts, seconds since midnight
+        array('i', [63000, 60300]),  # ends, seconds since midnight
+    )
+
+    Readers never wait: when the file changes, the new store is loaded in
+    the background while the previous one is still served. The file is
+    expected to only grow and only appended rows are parsed, see
+    SnapshotCache and PresenceCSVLoader. app.config['DATA_CSV'] can also be
+    a directory or a glob pattern of CSV partitions, of which only the
+    changed ones are parsed, in parallel, see PartitionedCSVLoader.
+
+    store[user_id] still returns the old nested dict layout for one user:
+    {
+        datetime.date(2013, 10, 1): {
+            'start': datetime.time(9, 0, 0),
+            'end': datetime.time(17, 30, 0),
+        },
     }
+
+    When app.config['DATA_SNAPSHOT'] is set, the binary snapshot compiled by
+    'bin/flask-ctl snapshot' is memory-mapped instead of parsing the CSV.
+    When app.config['SHARED_DATA_DIR'] is set, one process parses the CSV
+    and all processes map its snapshots, see SharedPresence.
+    """
+    if app.config['SHARED_DATA_DIR']:
+        return SHARED_DATA.get(
+            app.config['DATA_CSV'],
+            app.config['CACHE_CHECK_INTERVAL'],
+        )
+    if app.config['DATA_SNAPSHOT']:
+        return SNAPSHOT_DATA.get(
+            app.config['DATA_SNAPSHOT'],
+            app.config['CACHE_CHECK_INTERVAL'],
+        )
+    return PRESENCE_DATA.get(
+        app.config['DATA_CSV'],
+        app.config['CACHE_CHECK_INTERVAL'],
+    )
+
+
+# Values of the 'stat' request argument and names of the statistics.
+STATISTICS = {'mean': 'mean', 'median': 'p50', 'p10': 'p10', 'p90': 'p90'}
+
+
+def date_range_arg():
     """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
+    Returns (first, last) day ordinals of 'from' and 'to' request arguments.
 
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
+    Both are optional YYYY-MM-DD dates, inclusive; missing ones are None.
+    Malformed dates abort the request with 400 Bad Request.
+    """
+    try:
+        return tuple(
+            parse_day(request.args[name]) if request.args.get(name) else None
+            for name in ('from', 'to')
+        )
+    except ValueError:
+        abort(400)
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
 
-    return data
+def statistic_arg():
+    """
+    Returns statistic selected by the 'stat' request argument.
+
+    It's "mean" (the default), "median", "p10" or "p90"; the median is
+    returned as "p50". Other values abort the request with 400 Bad Request.
+    """
+    stat = request.args.get('stat', 'mean')
+    stat = STATISTICS.get(stat)
+    if stat is None:
+        abort(400)
+    return stat
+
+
+def user_ids_arg(data):
+    """
+    Returns user ids of the 'users' request argument.
+
+    It's a comma separated list of ids, "all" (the default) stands for all
+    users of data. Malformed ids abort the request with 400 Bad Request.
+    """
+    users = request.args.get('users', 'all')
+    if users == 'all':
+        return data.keys()
+    try:
+        return [int(user_id) for user_id in users.split(',')]
+    except ValueError:
+        abort(400)
+
+
+def data_version():
+    """
+    Returns version of the currently loaded presence data.
+    """
+    return get_data().version
 
 
 def group_by_weekday(items):
@@ -163,32 +321,129 @@ def group_by_weekday_in_secs(items):
 
 def parse_users_xml():
     """
-    Parses user information
+    Returns users information from the XML file:
+    {141: {'name': 'Adam P.', 'avatar': 'https://host/api/images/users/141'}}
+    """
+    return get_users()['users']
+
+
+def get_users():
+    """
+    Returns snapshot of the users XML file, parsed once per its version:
+    {
+        'version': '27a4f-6f3-13e6d8e1a60',
+        'users': {user_id: {'name': ..., 'avatar': ...}},
+        'listing': [(user_id, {'name': ..., 'avatar': ...})],
+    }
+    where listing is sorted by name in app.config['USERS_LOCALE'] collation.
+    """
+    return USERS_DATA.get(
+        app.config['DATA_XML'],
+        app.config['CACHE_CHECK_INTERVAL'],
+    )
+
+
+def load_users_xml(path):
+    """
+    Parses users XML file into a get_users() snapshot.
     """
-    with open(app.config['DATA_XML'], 'r') as xmlfile:
-        tree = etree.parse(xmlfile)
-        server = tree.find('server')
-        host = server.find('host').text
-        protocol = server.find('protocol').text
-        users_element = tree.find('users')
+    version = signature_version(file_signature(path))
+    with open(path, 'rb') as xmlfile:
         result = {
-            int(user.get('id')): {
-                'name': user.find('name').text,
-                'avatar': "{protocol}://{host}{avatar}".format(
-                    protocol=protocol,
-                    host=host,
-                    avatar=user.find('avatar').text
-                    )
-            } for user in users_element
+            user_id: {'name': name, 'avatar': avatar}
+            for user_id, name, avatar in iter_users_xml(xmlfile)
         }
-    return result
+
+    sort_key = collation.sort_key(app.config['USERS_LOCALE'])
+    listing = sorted(
+        result.items(),
+        key=lambda item: sort_key(item[1]['name']),
+    )
+    return {'version': version, 'users': result, 'listing': listing}
+
+
+def iter_users_xml(xmlfile):
+    """
+    Yields (user_id, name, avatar_url) of users XML file in a streaming way.
+
+    Every <user> element is cleared and dropped right after it's read, so
+    memory doesn't grow with the size of the file. Avatar URLs are built
+    from <server> protocol and host; users which come before <server> are
+    held back until it's read.
+    """
+    server = None
+    pending = []
+    for _, element in etree.iterparse(
+            xmlfile, events=('end',), tag=('server', 'user')):
+        if element.tag == 'server':
+            server = '{protocol}://{host}'.format(
+                protocol=element.findtext('protocol'),
+                host=element.findtext('host'),
+            )
+            for user_id, name, avatar in pending:
+                yield user_id, name, server + avatar
+            pending = []
+        else:
+            record = (
+                int(element.get('id')),
+                element.findtext('name'),
+                element.findtext('avatar'),
+            )
+            if server is None:
+                pending.append(record)
+            else:
+                yield record[0], record[1], server + record[2]
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
+USERS_DATA = CACHES['users'] = SnapshotCache(
+    'users', load_users_xml, file_signature,
+)
+
+
+def users_version():
+    """
+    Returns version of the currently loaded users XML.
+    """
+    return get_users()['version']
+
+
+def xml_synchronizer():
+    """
+    Returns synchronizer of DATA_XML with XML_SOURCE of current config.
+    """
+    global XML_SYNCHRONIZER  # pylint: disable-msg=W0603
+    source, path = app.config['XML_SOURCE'], app.config['DATA_XML']
+    synchronizer = XML_SYNCHRONIZER
+    if synchronizer is None or (
+            (synchronizer.source, synchronizer.path) != (source, path)):
+        synchronizer = XML_SYNCHRONIZER = UsersXMLSynchronizer(
+            source, path, on_update=USERS_DATA.clear,
+        )
+    return synchronizer
+
+
+def warm_up():
+    """
+    Returns warm-up of the presence store, users XML and app.config[
+    'WARM_UP_URLS'], created once; start() it to load them.
+    """
+    global WARM_UP  # pylint: disable-msg=W0603
+    if WARM_UP is None:
+        WARM_UP = WarmUp(
+            app,
+            [('presence', get_data), ('users', get_users)],
+            app.config['WARM_UP_URLS'],
+        )
+    return WARM_UP
 
 
 def update_xml_file():
     """
-    Updates users.xml file
+    Updates users.xml file if the source has changed.
+
+    Returns True if the file was replaced, see UsersXMLSynchronizer.
     """
-    with open(app.config['DATA_XML'], 'w+') as xmlfile:
-        response = urllib2.urlopen(app.config['XML_SOURCE'])
-        new_data = response.read()
-        xmlfile.write(new_data)
+    return xml_synchronizer().sync()
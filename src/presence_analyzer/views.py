@@ -4,23 +4,73 @@ Defines views.
 """
 
 import calendar
+import time
+from json import dumps
 
-from flask import redirect, url_for
+from flask import Response, abort, g, redirect, request, url_for
 from flask.helpers import make_response
 from flask.ext.mako import MakoTemplates, render_template
 from mako.exceptions import TopLevelLookupException
 
 
 from presence_analyzer.main import app
-from presence_analyzer import utils
+from presence_analyzer import aggregates, export, metrics, utils
 
 import logging
-import locale
 
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
 mako = MakoTemplates(app)
 
 
+@app.before_request
+def start_timer():
+    """
+    Remembers when handling of the request started.
+    """
+    g.started = time.time()
+
+
+@app.teardown_request
+def observe_request(exception=None):  # pylint: disable-msg=W0613
+    """
+    Records duration of the request in the endpoint's latency histogram.
+    """
+    started = getattr(g, 'started', None)
+    if started is not None:
+        metrics.REQUEST_SECONDS.observe(
+            time.time() - started, request.endpoint or 'unknown',
+        )
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_view():
+    """
+    Exposes request, stage, load and cache metrics for Prometheus.
+    """
+    return Response(
+        metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE,
+    )
+
+
+@app.route('/ready', methods=['GET'])
+def ready_view():
+    """
+    Readiness: 200 once warm-up is done (or if it's disabled), else 503.
+
+    Failed warm-up steps are listed in 'errors', the worker is ready
+    anyway and loads their data on demand.
+    """
+    if utils.WARM_UP is None:
+        status = {'state': 'ready', 'seconds': None, 'errors': {}}
+    else:
+        status = utils.WARM_UP.status()
+    return Response(
+        dumps(status),
+        status=200 if status['state'] == 'ready' else 503,
+        mimetype='application/json',
+    )
+
+
 @app.route('/')
 def mainpage():
     """
@@ -32,78 +82,199 @@ def mainpage():
 
 
 @app.route('/api/v1/users', methods=['GET'])
-@utils.jsonify
+@utils.cached_json(version=utils.users_version)
 def users_view():
     """
     Users listing for dropdown.
     """
-    data = utils.parse_users_xml()
-    locale.setlocale(locale.LC_COLLATE, 'pl_PL.UTF-8')
-    sorted_data = sorted(
-        data.items(),
-        key=lambda x: x[1]['name'],
-        cmp=locale.strcoll,
-    )
+    return utils.get_users()['listing']
+
+
+def percentiles_of(stat):
+    """
+    Returns percentiles weekday_stats() needs to compute given statistic.
+    """
+    return (int(stat[1:]),) if stat.startswith('p') else ()
+
+
+def format_mean_time_weekday(weekdays, stat='mean'):
+    """
+    Formats mean (or other statistic of) presence time grouped by weekday.
+    """
+    return [(calendar.day_abbr[weekday], stats['duration'][stat])
+            for weekday, stats in enumerate(weekdays)]
 
-    return sorted_data
+
+def format_presence_weekday(weekdays, stat=None):  # pylint: disable-msg=W0613
+    """
+    Formats total presence time grouped by weekday, with a header row.
+    """
+    result = [(calendar.day_abbr[weekday], stats['duration']['sum'])
+              for weekday, stats in enumerate(weekdays)]
+
+    result.insert(0, ('Weekday', 'Presence (s)'))
+    return result
+
+
+def format_presence_start_end(weekdays, stat='mean'):
+    """
+    Formats mean (or other statistic of) start and end of presence grouped
+    by weekday.
+    """
+    return [(calendar.day_abbr[weekday],
+             stats['start'][stat],
+             stats['end'][stat])
+            for weekday, stats in enumerate(weekdays)]
+
+
+# Metric names of the per-user endpoints with their formatters.
+METRICS = {
+    'mean_time_weekday': format_mean_time_weekday,
+    'presence_weekday': format_presence_weekday,
+    'presence_start_end': format_presence_start_end,
+}
 
 
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
-@utils.jsonify
+@utils.cached_json(version=utils.data_version)
 def mean_time_weekday_view(user_id):
     """
     Returns mean presence time of given user grouped by weekday.
+
+    Optional 'from' and 'to' arguments (YYYY-MM-DD) limit the date range,
+    'stat' selects median, p10 or p90 instead of the mean.
     """
     data = utils.get_data()
     if user_id not in data:
         log.debug('User %s not found!', user_id)
         return []
 
-    weekdays = utils.group_by_weekday(data[user_id])
-    result = [(calendar.day_abbr[weekday], utils.mean(intervals))
-              for weekday, intervals in weekdays.items()]
-
-    return result
+    stat = utils.statistic_arg()
+    first, last = utils.date_range_arg()
+    weekdays = data.weekday_stats(user_id, first, last, percentiles_of(stat))
+    return format_mean_time_weekday(weekdays, stat)
 
 
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
-@utils.jsonify
+@utils.cached_json(version=utils.data_version)
 def presence_weekday_view(user_id):
     """
     Returns total presence time of given user grouped by weekday.
+
+    Optional 'from' and 'to' arguments (YYYY-MM-DD) limit the date range.
     """
     data = utils.get_data()
     if user_id not in data:
         log.debug('User %s not found!', user_id)
         return []
 
-    weekdays = utils.group_by_weekday(data[user_id])
-    result = [(calendar.day_abbr[weekday], sum(intervals))
-              for weekday, intervals in weekdays.items()]
-
-    result.insert(0, ('Weekday', 'Presence (s)'))
-    return result
+    weekdays = data.weekday_stats(user_id, *utils.date_range_arg())
+    return format_presence_weekday(weekdays)
 
 
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
-@utils.jsonify
+@utils.cached_json(version=utils.data_version)
 def presence_start_end(user_id):
     """
     Returns mean presence time of given user
+
+    Optional 'from' and 'to' arguments (YYYY-MM-DD) limit the date range,
+    'stat' selects median, p10 or p90 instead of the mean.
     """
     data = utils.get_data()
     if user_id not in data:
         log.debug('User %s not found!', user_id)
         return []
 
-    weekdays = utils.group_by_weekday_in_secs(data[user_id])
-    result = [(calendar.day_abbr[weekday],
-              utils.mean(mean_per_day['start']),
-              utils.mean(mean_per_day['end']))
-              for weekday, mean_per_day in weekdays.items()]
+    stat = utils.statistic_arg()
+    first, last = utils.date_range_arg()
+    weekdays = data.weekday_stats(user_id, first, last, percentiles_of(stat))
+    return format_presence_start_end(weekdays, stat)
+
+
+@app.route('/api/v1/batch', methods=['GET'])
+@utils.cached_json(version=utils.data_version)
+def batch_view():
+    """
+    Returns metrics of many users at once, keyed by user id and metric.
+
+    'users' is a comma separated list of ids or "all", 'metrics' a comma
+    separated list of METRICS names (all of them by default). Statistics
+    of every user are computed once and shared by all requested metrics.
+    Optional 'from', 'to' and 'stat' arguments work like in the per-user
+    endpoints. Users without presence data get empty results, like there.
+    """
+    names = request.args.get('metrics')
+    names = names.split(',') if names else sorted(METRICS)
+    if ('users' not in request.args or
+            any(name not in METRICS for name in names)):
+        abort(400)
+
+    data = utils.get_data()
+    stat = utils.statistic_arg()
+    first, last = utils.date_range_arg()
+    result = {}
+    for user_id in utils.user_ids_arg(data):
+        if user_id not in data:
+            log.debug('User %s not found!', user_id)
+            result[user_id] = {name: [] for name in names}
+            continue
+        weekdays = data.weekday_stats(
+            user_id, first, last, percentiles_of(stat),
+        )
+        result[user_id] = {
+            name: METRICS[name](weekdays, stat) for name in names
+        }
     return result
 
 
+@app.route('/api/v1/presence_summary', methods=['GET'])
+@utils.cached_json(version=utils.data_version)
+def presence_summary_view():
+    """
+    Returns presence statistics of many users together grouped by weekday.
+
+    Every weekday has the number of users and rows and count, sum, mean,
+    min, max and percentiles of duration, start and end. Optional 'users'
+    (comma separated ids, all by default), 'from' and 'to' arguments
+    select the rows.
+    """
+    data = utils.get_data()
+    weekdays = aggregates.summarize(
+        data, utils.user_ids_arg(data), *utils.date_range_arg()
+    )
+    return [(calendar.day_abbr[weekday], stats)
+            for weekday, stats in enumerate(weekdays)]
+
+
+@app.route('/api/v1/export', methods=['GET'])
+def export_view():
+    """
+    Streams presence data of selected users as CSV or NDJSON.
+
+    'kind' is "raw" (rows of the data CSV, the default) or "weekday"
+    (weekday totals), 'format' is "csv" (the default) or "ndjson". Optional
+    'users' (comma separated ids, all by default), 'from' and 'to'
+    arguments select the rows. The body is generated user by user and sent
+    with chunked transfer encoding.
+    """
+    kind = request.args.get('kind', 'raw')
+    output = request.args.get('format', 'csv')
+    if kind not in export.KINDS or output not in export.FORMATS:
+        abort(400)
+
+    data = utils.get_data()
+    chunks = export.export(
+        data, utils.user_ids_arg(data), kind, output,
+        *utils.date_range_arg()
+    )
+    response = Response(chunks, mimetype=export.FORMATS[output][0])
+    response.headers['Content-Disposition'] = (
+        'attachment; filename=presence-%s.%s' % (kind, output)
+    )
+    return response
+
+
 @app.route('/<string:template_name>', methods=['GET'])
 def template_view(template_name):
     """
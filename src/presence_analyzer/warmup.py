@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Loading of data sources ahead of the first request.
+"""
+
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+class WarmUp(object):
+    """
+    Runs load tasks in parallel threads, then requests given urls.
+
+    Tasks are (name, function) pairs, e.g. loading the presence store and
+    the users XML, which don't depend on each other. Once all of them
+    finish, urls are requested through app.test_client() one by one, so
+    that responses depending on both are computed and cached too. A failed
+    task or url is logged and recorded in errors; it doesn't stop the
+    others, the app then loads it on demand as usual.
+    """
+
+    def __init__(self, app, tasks, urls=()):
+        self.app = app
+        self.tasks = list(tasks)
+        self.urls = list(urls)
+        self.errors = {}
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """
+        Starts warming up in a background thread, only the first time.
+        """
+        if self.thread is not None:
+            return
+        self.started = time.time()
+        self.thread = threading.Thread(target=self._run, name='warm-up')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until warm-up is done, returns False on timeout.
+        """
+        return self.done.wait(timeout)
+
+    def state(self):
+        """
+        Returns 'pending', 'running' or 'ready'.
+
+        Warm-up is ready once done, even if some steps failed: what they
+        didn't load is loaded on demand, see errors.
+        """
+        if self.thread is None:
+            return 'pending'
+        if not self.done.is_set():
+            return 'running'
+        return 'ready'
+
+    def status(self):
+        """
+        Returns JSON serializable state of the warm-up.
+        """
+        finished = self.finished if self.done.is_set() else time.time()
+        return {
+            'state': self.state(),
+            'seconds': finished - self.started if self.started else None,
+            'errors': dict(self.errors),
+        }
+
+    def _run(self):
+        """
+        Runs all tasks, then requests all urls.
+        """
+        try:
+            threads = [
+                threading.Thread(
+                    target=self._task, args=(name, function),
+                    name='warm-up-%s' % name,
+                )
+                for name, function in self.tasks
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            client = self.app.test_client()
+            for url in self.urls:
+                self._task(url, lambda: self._get(client, url))
+            log.info(
+                'Warmed up in %.2f s', time.time() - self.started,
+            )
+        finally:
+            self.finished = time.time()
+            self.done.set()
+
+    def _task(self, name, function):
+        """
+        Calls function, recording its failure under name.
+        """
+        try:
+            function()
+        except Exception as error:  # pylint: disable-msg=W0703
+            log.exception('Warming up %s failed', name)
+            self.errors[name] = '%s: %s' % (type(error).__name__, error)
+
+    @staticmethod
+    def _get(client, url):
+        """
+        Requests url, raises IOError unless it succeeds.
+        """
+        response = client.get(url)
+        if response.status_code != 200:
+            raise IOError('Status %d' % response.status_code)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Synchronization of the users XML file with the intranet export.
+"""
+
+import logging
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import urllib2
+
+from lxml import etree
+
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+# Amount of bytes copied from the response at once.
+CHUNK_SIZE = 1 << 16
+
+
+class UsersXMLSynchronizer(object):
+    """
+    Downloads users XML from source URL into path when it has changed.
+
+    Requests are conditional (If-None-Match with the last ETag,
+    If-Modified-Since with the last Last-Modified), so an unchanged export
+    isn't downloaded again. The first request is unconditional: the mtime
+    of a file already at path, e.g. the bundled one, says when it was
+    checked out, not when the export was made. The body is streamed into
+    a temporary file next to path and renamed over it, so readers never see
+    a partial file. A body which isn't well-formed XML, e.g. a truncated
+    download or an HTML error page, is rejected and leaves the file
+    untouched. on_update is called after the file is replaced.
+    """
+
+    def __init__(self, source, path, on_update=None, timeout=30):
+        self.source = source
+        self.path = path
+        self.on_update = on_update
+        self.timeout = timeout
+        self.etag = None
+        self.last_modified = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def sync(self):
+        """
+        Synchronizes the file once. Returns True if it was replaced.
+        """
+        request = urllib2.Request(self.source)
+        if self.etag is not None:
+            request.add_header('If-None-Match', self.etag)
+        if self.last_modified is not None:
+            request.add_header('If-Modified-Since', self.last_modified)
+
+        try:
+            response = urllib2.urlopen(request, timeout=self.timeout)
+        except urllib2.HTTPError as error:
+            if error.code == 304:
+                return False
+            raise
+
+        try:
+            self._replace(response)
+            headers = response.info()
+            self.etag = headers.getheader('ETag')
+            self.last_modified = headers.getheader('Last-Modified')
+        finally:
+            response.close()
+
+        if self.on_update is not None:
+            self.on_update()
+        return True
+
+    def _replace(self, response):
+        """
+        Streams response body into a temporary file and renames it to path.
+
+        Raises etree.XMLSyntaxError if the body isn't well-formed XML.
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        handle, temporary = tempfile.mkstemp(
+            dir=directory, prefix='.', suffix='.xml.tmp',
+        )
+        try:
+            with os.fdopen(handle, 'wb') as xmlfile:
+                shutil.copyfileobj(response, xmlfile, CHUNK_SIZE)
+            etree.parse(temporary)
+            mode = 0644
+            if os.path.exists(self.path):
+                mode = stat.S_IMODE(os.stat(self.path).st_mode)
+            os.chmod(temporary, mode)
+            os.rename(temporary, self.path)
+        except Exception:
+            os.remove(temporary)
+            raise
+
+    def start(self, interval):
+        """
+        Synchronizes the file every interval seconds in a daemon thread.
+        """
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self._run, args=(interval,), name='users-xml-sync',
+        )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops the synchronization thread.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self, interval):
+        """
+        Synchronization loop, errors are logged and retried next time.
+
+        The file is synchronized at least once, even if stopped right away.
+        """
+        while True:
+            try:
+                if self.sync():
+                    log.info('Updated %s from %s', self.path, self.source)
+            except Exception:  # pylint: disable-msg=W0703
+                log.exception('Synchronizing %s failed', self.path)
+            if self.stopped.wait(interval):
+                break